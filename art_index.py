@@ -0,0 +1,78 @@
+import sqlite3
+import threading
+import numpy as np
+from io import BytesIO
+from PIL import Image
+
+ART_INDEX_PATH = "data/art_hashes.sqlite"
+# Bumped whenever image_hash_from_bytes changes, hashes from an older scheme are not comparable
+ART_HASH_TABLE = "art_hashes_v2"
+
+HASH_SIZE = 8
+
+# Distance reported when there is nothing to compare against, larger than any 64-bit Hamming distance
+NO_MATCH_DISTANCE = 1000
+
+
+def image_hash_from_bytes(content: bytes):
+    # 64-bit average hash packed into an int, first pixel in the highest bit. Only an 8x8 greyscale thumbnail
+    # is needed, so JPEGs are decoded at reduced scale and shrunk with a box filter instead of LANCZOS.
+    image = Image.open(BytesIO(content))
+    image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+    pixels = np.asarray(image.convert("L").resize((HASH_SIZE, HASH_SIZE), Image.Resampling.BOX), dtype=np.float32)
+    return int(np.packbits(pixels > pixels.mean()).view(">u8")[0])
+
+
+def hamming_distances(hashes: np.ndarray, target_hash: int):
+    # Distance from target_hash to every hash in a uint64 array in one pass
+    differing_bits = np.bitwise_xor(hashes, np.uint64(target_hash))
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(differing_bits).astype(np.int64)
+    return np.unpackbits(differing_bits.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+
+def printing_hash_arrays(printing_hashes: list[int], is_good_art: list[bool]):
+    return np.array(printing_hashes, dtype=np.uint64), np.array(is_good_art, dtype=bool)
+
+
+def best_art_distances(printing_hashes: np.ndarray, is_good_art: np.ndarray, target_hash: int):
+    # Closest distance to a printing with the wanted illustration and to one with any other illustration
+    distances = hamming_distances(printing_hashes, target_hash)
+    good_distances = distances[is_good_art]
+    bad_distances = distances[~is_good_art]
+    return (int(good_distances.min()) if len(good_distances) else NO_MATCH_DISTANCE,
+            int(bad_distances.min()) if len(bad_distances) else NO_MATCH_DISTANCE)
+
+
+class ArtHashIndex:
+    # Average hashes of Scryfall printing images, kept on disk so each printing is only ever downloaded once
+    def __init__(self, path: str = ART_INDEX_PATH):
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS {ART_HASH_TABLE} (card_id TEXT PRIMARY KEY, illustration_id TEXT, hash INTEGER NOT NULL)")
+            self.connection.execute(f"CREATE INDEX IF NOT EXISTS {ART_HASH_TABLE}_illustration ON {ART_HASH_TABLE} (illustration_id)")
+        return self.connection
+
+    def get(self, card_ids: list[str]):
+        # SQLite integers are signed, hashes are stored shifted into that range
+        found = {}
+        with self.lock:
+            connection = self._connect()
+            for start in range(0, len(card_ids), 500):
+                batch = card_ids[start:start + 500]
+                rows = connection.execute(f"SELECT card_id, hash FROM {ART_HASH_TABLE} WHERE card_id IN ({','.join('?' * len(batch))})", batch)
+                for card_id, stored_hash in rows:
+                    found[card_id] = stored_hash + (1 << 63)
+        return found
+
+    def put(self, card_id: str, illustration_id: str, art_hash: int):
+        with self.lock:
+            connection = self._connect()
+            connection.execute(f"INSERT OR REPLACE INTO {ART_HASH_TABLE} (card_id, illustration_id, hash) VALUES (?, ?, ?)",
+                               (card_id, illustration_id, art_hash - (1 << 63)))
+            connection.commit()
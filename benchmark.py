@@ -0,0 +1,184 @@
+import argparse
+import io
+import json
+import os
+import random
+import time
+from contextlib import redirect_stdout
+import retailer_selection
+from listing_pipeline import ListingFilters, validate_listings
+from metrics import Metrics
+
+BENCHMARK_REPORT_PATH = "data/benchmarks.jsonl"
+# requests_cache database holding recorded Moxfield, Snapcaster and Scryfall responses
+FIXTURE_PATH = "data/fixtures/replay"
+
+DEFAULT_SIZES = [50, 100, 300, 1000]
+DEFAULT_VENDORS = 40
+# Raw Snapcaster results per card, before filtering
+LISTINGS_PER_CARD = 40
+
+# Same scale as snapscraper.WEAR_LEVELS, synthetic listings only use these conditions
+CONDITION_LEVELS = {"NM": 0, "LP": 1, "MP": 2, "HP": 3, "DMG": 4}
+MIN_ACCEPTABLE_CONDITION = 3
+
+
+def store_fees():
+    with open("data/websites.json", 'r') as websites_file:
+        return {store: website["fees"] for store, website in json.load(websites_file)["websites"].items()}
+
+
+def synthetic_listing(card_name: str, vendor: str, rnd: random.Random):
+    variant_id = rnd.randrange(10 ** 13, 10 ** 14)
+    return {
+        "name": card_name if rnd.random() > 0.1 else f"{card_name} // Token",
+        "vendor": vendor,
+        "website": vendor,
+        "price": round(rnd.lognormvariate(0.5, 1.0) + 0.25, 2),
+        "condition": rnd.choices(list(CONDITION_LEVELS), weights=[60, 20, 10, 7, 3])[0],
+        "art_series": rnd.random() < 0.02,
+        "foil": "foil" if rnd.random() < 0.15 else "",
+        "set": rnd.choice(["Commander Legends", "Dominaria United", "Secret Lair", "Double Masters"]),
+        "showcase": "",
+        "frame": "",
+        "link": f"https://www.{vendor}.com/products/{card_name.lower().replace(' ', '-')}?variant={variant_id}",
+        "image": f"https://cdn.shopify.com/s/files/{variant_id}.jpg",
+        "variant_id": variant_id,
+    }
+
+
+def synthetic_deck(num_cards: int, num_vendors: int, seed: int = 1):
+    # Raw Snapcaster results per card, from vendors that have real fee tiers in data/websites.json.
+    # Popular vendors carry more cards, like the real catalog.
+    rnd = random.Random(seed)
+    vendors = list(store_fees())
+    if num_vendors > len(vendors):
+        raise ValueError(f"data/websites.json only has {len(vendors)} vendors")
+    vendors = rnd.sample(vendors, num_vendors)
+    vendor_weights = [1 / (rank + 1) for rank in range(num_vendors)]
+    raw_listings = {}
+    for card_num in range(num_cards):
+        card_name = f"Synthetic Card {card_num}"
+        card_vendors = rnd.choices(vendors, weights=vendor_weights, k=rnd.randint(1, LISTINGS_PER_CARD))
+        raw_listings[card_name] = sorted((synthetic_listing(card_name, vendor, rnd) for vendor in card_vendors), key=lambda listing: listing["price"])
+    return raw_listings, set(vendors)
+
+
+def bench_validation(raw_listings: dict, listing_filters: ListingFilters):
+    moxfield_cards = {}
+    retailer_names = set()
+    start_time = time.perf_counter()
+    for card_name, listings in raw_listings.items():
+        stat_map = {"site": 0, "name": 0, "foil": 0, "art_series": 0, "shopify": 0, "condition": 0, "valid_listings": 0}
+        card_listings = validate_listings(card_name, listings, listing_filters, stat_map)
+        if card_listings:
+            moxfield_cards[card_name] = {"cardName": card_name, "isFoil": False, "listings": card_listings}
+            retailer_names.update(card_listings)
+    return time.perf_counter() - start_time, moxfield_cards, retailer_names
+
+
+def bench_optimize(moxfield_cards: dict, retailer_names: set, time_limit: float | None, num_workers: int):
+    # The solver's own prints are swallowed, only the spans are kept
+    run_metrics = Metrics()
+    start_time = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        total_cost = retailer_selection.process(moxfield_cards, retailer_names, time_limit, num_workers, metrics=run_metrics)
+    elapsed = time.perf_counter() - start_time
+    phases = {phase: round(totals["total"], 4) for phase, totals in run_metrics.phase_totals().items()}
+    return elapsed, total_cost, phases
+
+
+def previous_results(report_path: str):
+    # Latest recorded result per (cards, vendors, seed, time_limit, workers)
+    results = {}
+    if not os.path.exists(report_path):
+        return results
+    with open(report_path, 'r') as report_file:
+        for line in report_file:
+            if line.strip():
+                result = json.loads(line)
+                results[(result["cards"], result["vendors"], result["seed"], result["time_limit"], result["workers"])] = result
+    return results
+
+
+def percent_change(current: float, previous: float | None):
+    if not previous:
+        return ""
+    return f" ({100 * (current - previous) / previous:+.0f}%)"
+
+
+def run_scaling(sizes: list[int], num_vendors: int, seed: int, time_limit: float | None, num_workers: int, report_path: str):
+    previous = previous_results(report_path)
+    listing_filters = ListingFilters([], CONDITION_LEVELS, MIN_ACCEPTABLE_CONDITION)
+    print(f"{'cards':>6} {'listings':>9} {'validate':>16} {'presolve':>16} {'build':>16} {'solve':>16} {'optimize':>16} {'cost':>10}")
+    for num_cards in sizes:
+        raw_listings, vendors = synthetic_deck(num_cards, num_vendors, seed)
+        validation_time, moxfield_cards, retailer_names = bench_validation(raw_listings, listing_filters)
+        optimize_time, total_cost, phases = bench_optimize(moxfield_cards, retailer_names, time_limit, num_workers)
+        result = {"time": time.time(), "cards": num_cards, "vendors": num_vendors, "seed": seed, "time_limit": time_limit, "workers": num_workers,
+                  "raw_listings": sum(len(listings) for listings in raw_listings.values()),
+                  "validation": round(validation_time, 4), "optimize": round(optimize_time, 4),
+                  "presolve": phases.get("presolve", 0.0), "model_build": phases.get("model_build", 0.0), "solve": phases.get("solve", 0.0),
+                  "total_cost": total_cost}
+
+        last = previous.get((num_cards, num_vendors, seed, time_limit, num_workers), {})
+        columns = [f"{result[key]:.3f}s{percent_change(result[key], last.get(key))}" for key in ("validation", "presolve", "model_build", "solve", "optimize")]
+        print(f"{num_cards:>6} {result['raw_listings']:>9} " + " ".join(f"{column:>16}" for column in columns) + f" {total_cost:>10.2f}", flush=True)
+        if last and last.get("total_cost") != total_cost:
+            print(f"{'':>6} cost changed from {last.get('total_cost')} to {total_cost}")
+
+        directory = os.path.dirname(report_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(report_path, 'a') as report_file:
+            report_file.write(json.dumps(result) + "\n")
+
+
+def run_scrape(deck_id: str, fixture_path: str, replay: bool):
+    # Recording runs the real scrape with the usual rate limits but keeps every response in the fixture cache for good,
+    # replaying answers only from that cache with no rate limiting, anything that was never recorded comes back as a 504
+    import snapscraper
+    from http_cache import PolicyCachedSession
+    from rate_limiter import RateLimiter
+
+    directory = os.path.dirname(fixture_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    snapscraper.request_session = PolicyCachedSession(fixture_path, expire_after=-1, only_if_cached=replay)
+    if replay:
+        snapscraper.rate_limiter = RateLimiter({}, 0)
+
+    start_time = time.perf_counter()
+    moxfield_cards = snapscraper.get_cards_from_moxfield_deck(deck_id)
+    snapscraper.number_of_cards = len(moxfield_cards)
+    fetch_time = time.perf_counter() - start_time
+    retailer_names, cards_to_drop = snapscraper.scrape_cards(moxfield_cards, snapscraper.new_card_miss_stats(moxfield_cards))
+    scrape_time = time.perf_counter() - start_time - fetch_time
+    print(f"{'Replayed' if replay else 'Recorded'} {len(moxfield_cards)} cards from {len(retailer_names)} vendors ({len(cards_to_drop)} dropped): "
+          f"deck fetch {fetch_time:.3f}s, scrape {scrape_time:.3f}s")
+    for phase, phase_totals in snapscraper.metrics.phase_totals().items():
+        print(f"{phase}: {phase_totals['count']}x, {phase_totals['total']:.3f}s total, {phase_totals['max']:.3f}s max")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the scrape, validate and optimize pipeline without live services")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    scale_parser = subparsers.add_parser("scale", help="Validate and optimize synthetic decks of increasing size")
+    scale_parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="Comma separated deck sizes")
+    scale_parser.add_argument("--vendors", type=int, default=DEFAULT_VENDORS)
+    scale_parser.add_argument("--seed", type=int, default=1)
+    scale_parser.add_argument("--time-limit", type=float, default=None)
+    scale_parser.add_argument("--workers", type=int, default=0)
+    scale_parser.add_argument("--report", default=BENCHMARK_REPORT_PATH)
+
+    for command, help_text in (("record", "Scrape a deck live and keep every response as a fixture"), ("replay", "Scrape a deck from recorded fixtures only")):
+        scrape_parser = subparsers.add_parser(command, help=help_text)
+        scrape_parser.add_argument("deck_id")
+        scrape_parser.add_argument("--fixtures", default=FIXTURE_PATH)
+
+    args = parser.parse_args()
+    if args.command == "scale":
+        run_scaling([int(size) for size in args.sizes.split(",")], args.vendors, args.seed, args.time_limit, args.workers, args.report)
+    else:
+        run_scrape(args.deck_id, args.fixtures, args.command == "replay")
@@ -0,0 +1,99 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests_cache import CachedSession
+from rate_limiter import host_from_url
+
+# Table in the cache database holding when each cached response was last used
+ACCESS_TABLE = "access_times"
+
+# Background refreshes of stale responses running at once
+REVALIDATE_CONCURRENCY = 4
+
+
+class PolicyCachedSession(CachedSession):
+    # CachedSession with per-domain hit/miss counters, least recently used eviction once the cache grows past
+    # max_cache_bytes, and stale-while-revalidate refreshes that go through before_refresh (e.g. a rate limiter)
+    def __init__(self, cache_name: str, max_cache_bytes: int | None = None, before_refresh=None, **kwargs):
+        super().__init__(cache_name, **kwargs)
+        self.max_cache_bytes = max_cache_bytes
+        self.before_refresh = before_refresh
+        self.cache_stats = {}
+        self.access_times = {}
+        self.stats_lock = threading.Lock()
+        self.revalidate_executor = ThreadPoolExecutor(max_workers=REVALIDATE_CONCURRENCY)
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        # only_if_cached answers a miss with a generated 504 that never touched the network, the real fetch is counted instead
+        if request.method == "GET" and not (response.from_cache and response.status_code == 504):
+            if not response.from_cache:
+                outcome = "misses"
+            elif response.is_expired:
+                outcome = "stale"
+            else:
+                outcome = "hits"
+            with self.stats_lock:
+                domain_stats = self.cache_stats.setdefault(host_from_url(request.url), {"hits": 0, "stale": 0, "misses": 0})
+                domain_stats[outcome] += 1
+                if getattr(response, "cache_key", None):
+                    self.access_times[response.cache_key] = time.time()
+        return response
+
+    def cached(self, url: str, headers=None):
+        # Answers from the cache without touching the network, None if nothing usable is stored. A stale response
+        # inside its stale_while_revalidate window is returned right away and refreshed in the background.
+        response = self.get(url, headers=headers, only_if_cached=True)
+        if response.from_cache and response.status_code == 504:
+            return None
+        return response
+
+    def _resend_async(self, request, *args, **kwargs):
+        self.revalidate_executor.submit(self._revalidate, request, *args, **kwargs)
+
+    def _revalidate(self, request, *args, **kwargs):
+        if self.before_refresh is not None:
+            self.before_refresh(request.url)
+        # The stale answer came from cached(), whose only-if-cached directive would let a CDN answer the refresh with a 504
+        request = request.copy()
+        directives = [directive.strip() for directive in request.headers.get("Cache-Control", "").split(",")]
+        directives = [directive for directive in directives if directive and directive.lower() != "only-if-cached"]
+        if directives:
+            request.headers["Cache-Control"] = ", ".join(directives)
+        else:
+            request.headers.pop("Cache-Control", None)
+        self._send_and_cache(request, *args, **kwargs)
+
+    def trim(self):
+        # Persists access times and evicts the least recently used responses until the cache fits in max_cache_bytes.
+        # Returns how many responses were removed.
+        responses = self.cache.responses
+        with self.stats_lock:
+            access_times = dict(self.access_times)
+            self.access_times.clear()
+        with responses.connection(commit=True) as connection:
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {ACCESS_TABLE} (key TEXT PRIMARY KEY, accessed REAL)")
+            connection.executemany(f"INSERT OR REPLACE INTO {ACCESS_TABLE} (key, accessed) VALUES (?, ?)", access_times.items())
+            if self.max_cache_bytes is None:
+                return 0
+            # Responses cached before access times were tracked count as the oldest
+            entries = connection.execute(f"SELECT r.key, length(r.value), coalesce(a.accessed, 0) FROM {responses.table_name} r "
+                                         f"LEFT JOIN {ACCESS_TABLE} a ON a.key = r.key ORDER BY 3").fetchall()
+
+        cache_bytes = sum(size for _, size, _ in entries)
+        evicted_keys = []
+        for key, size, _ in entries:
+            if cache_bytes <= self.max_cache_bytes:
+                break
+            evicted_keys.append(key)
+            cache_bytes -= size
+        if evicted_keys:
+            self.cache.delete(*evicted_keys)
+            with responses.connection(commit=True) as connection:
+                connection.execute(f"DELETE FROM {ACCESS_TABLE} WHERE key NOT IN (SELECT key FROM {responses.table_name})")
+            responses.vacuum()
+        return len(evicted_keys)
+
+    def stats(self):
+        with self.stats_lock:
+            return {domain: dict(domain_stats) for domain, domain_stats in self.cache_stats.items()}
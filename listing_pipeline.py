@@ -0,0 +1,241 @@
+import json
+import re
+import sys
+from itertools import islice
+
+# Snapcaster results past this point are never looked at
+MAX_LISTINGS = 500
+
+# Fields kept from a Snapcaster result, in the order they are written to card data files
+LISTING_FIELDS = ("vendor", "website", "name", "set", "condition", "foil", "art_series", "showcase", "frame", "price_cents", "variant_id", "link", "image", "stock")
+# Bumped whenever LISTING_FIELDS or the card data layout changes
+CARD_DATA_FORMAT = 3
+
+
+def store_url_from_listing(listing: dict[str, str]):
+    return listing['link'].split('/products/')[0]
+
+
+class Listing:
+    # One Snapcaster result cut down to the fields the pipeline reads. Item access (listing["vendor"]) works like it
+    # did on the raw dicts, listing["price"] is still in dollars while price_cents is exact.
+    __slots__ = LISTING_FIELDS
+
+    def __init__(self, vendor, website, name, set_name, condition, foil, art_series, showcase, frame, price_cents, variant_id, link, image, stock=None):
+        # Vendors, names, sets and conditions repeat across thousands of listings, so each string is kept once
+        self.vendor = sys.intern(vendor)
+        self.website = sys.intern(website)
+        self.name = sys.intern(name)
+        self.set = sys.intern(set_name)
+        self.condition = sys.intern(condition)
+        self.foil = foil
+        self.art_series = art_series
+        self.showcase = showcase
+        self.frame = frame
+        self.price_cents = price_cents
+        self.variant_id = variant_id
+        self.link = link
+        self.image = image
+        # Copies in stock, None when Snapcaster doesn't say
+        self.stock = stock
+
+    @classmethod
+    def from_snapcaster(cls, result: dict):
+        return cls(result["vendor"], result.get("website") or result["vendor"], result["name"], result.get("set") or "",
+                   result.get("condition") or "", result.get("foil") or "", bool(result.get("art_series")),
+                   result.get("showcase") or "", result.get("frame") or "", round(100 * float(result["price"])),
+                   result.get("variant_id"), result["link"], result.get("image") or "", result.get("stock"))
+
+    @classmethod
+    def from_row(cls, row: list):
+        return cls(*row)
+
+    def to_row(self):
+        return [getattr(self, field) for field in LISTING_FIELDS]
+
+    @property
+    def price(self):
+        return self.price_cents / 100
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key: str, default=None):
+        return getattr(self, key, default)
+
+    def __repr__(self):
+        return f"Listing({self.vendor!r}, {self.name!r}, {self.price_cents})"
+
+
+def as_listing(listing):
+    return listing if isinstance(listing, Listing) else Listing.from_snapcaster(listing)
+
+
+def listings_from_results(results: list[dict]):
+    return [Listing.from_snapcaster(result) for result in results]
+
+
+class ListingFilters:
+    # Compiled once per run and shared between card workers, every lookup is read-only apart from the vendor cache
+    def __init__(self, filtered_sites: list[str], wear_levels: dict[str, int], min_acceptable_condition: int):
+        self.site_pattern = re.compile("|".join(re.escape(site) for site in filtered_sites)) if filtered_sites else None
+        # Unknown condition strings are rejected rather than raising a KeyError halfway through a card
+        self.acceptable_conditions = frozenset(condition for condition, level in wear_levels.items() if level <= min_acceptable_condition)
+        self.blocked_vendors = {}
+
+    def is_blocked_site(self, listing: dict):
+        if self.site_pattern is None:
+            return False
+        vendor = listing["vendor"]
+        blocked = self.blocked_vendors.get(vendor)
+        if blocked is None:
+            blocked = self.site_pattern.search(store_url_from_listing(listing)) is not None
+            self.blocked_vendors[vendor] = blocked
+        return blocked
+
+    def stages(self, card_name: str):
+        # (card_miss_stats key, predicate that is True when the listing should be dropped)
+        return [
+            ("site", self.is_blocked_site),
+            ("name", lambda listing: listing["name"] != card_name),
+            # ("foil", lambda listing: (listing["foil"] != '') != (card_data["isFoil"] == True)),
+            ("art_series", lambda listing: bool(listing["art_series"])),
+            # ("shopify", lambda listing: "shopify" not in listing["image"]),
+            ("condition", lambda listing: listing["condition"] not in self.acceptable_conditions),
+        ]
+
+    def rejection(self, card_name: str, listing: dict):
+        # Returns the card_miss_stats key of the first filter the listing fails, or None if it is valid
+        for stat_key, rejects in self.stages(card_name):
+            if rejects(listing):
+                return stat_key
+        return None
+
+    def apply(self, card_name: str, listings, stat_map: dict | None = None, extra_stages=()):
+        stream = iter(listings)
+        for stat_key, rejects in [*self.stages(card_name), *extra_stages]:
+            stream = reject_listings(stream, stat_key, rejects, stat_map)
+        return stream
+
+
+def reject_listings(listings, stat_key: str, rejects, stat_map: dict | None = None):
+    for listing in listings:
+        if rejects(listing):
+            if stat_map is not None:
+                stat_map[stat_key] += 1
+            continue
+        yield listing
+
+
+def cheapest_per_vendor(listings, vendor_listings: dict | None = None, stat_map: dict | None = None):
+    # Keeps the first of the cheapest listings per vendor, in order of first appearance
+    vendor_listings = {} if vendor_listings is None else vendor_listings
+    for listing in listings:
+        if stat_map is not None:
+            stat_map["valid_listings"] += 1
+        retailer = listing["vendor"]
+        if retailer in vendor_listings and listing["price"] >= vendor_listings[retailer]["price"]:
+            continue
+        vendor_listings[retailer] = listing
+    return vendor_listings
+
+
+def vendor_offers(listings, quantity: int):
+    # Each vendor's cheapest listings, in price order, until their stock covers quantity. Unknown stock counts as enough.
+    offers = {}
+    covered = {}
+    for listing in sorted(listings, key=lambda listing: listing["price"]):
+        vendor = listing["vendor"]
+        stock = listing.get("stock")
+        if covered.get(vendor, 0) >= quantity or stock == 0:
+            continue
+        offers.setdefault(vendor, []).append(listing)
+        covered[vendor] = covered.get(vendor, 0) + (quantity if stock is None else stock)
+    return offers
+
+
+def validate_listings(card_name: str, listings, listing_filters: ListingFilters, stat_map: dict | None = None, extra_stages=()):
+    valid_listings = listing_filters.apply(card_name, islice(listings, MAX_LISTINGS), stat_map, extra_stages)
+    return cheapest_per_vendor(valid_listings, stat_map=stat_map)
+
+
+def read_listings(source):
+    # Accepts a path or an open text stream holding a Snapcaster response, a JSON list of listings or JSON lines
+    if isinstance(source, str):
+        with open(source, 'r') as listing_file:
+            yield from read_listings(listing_file)
+        return
+
+    first_line = source.readline()
+    while first_line and not first_line.strip():
+        first_line = source.readline()
+    if not first_line:
+        return
+
+    try:
+        first_listing = json.loads(first_line)
+    except json.JSONDecodeError:
+        first_listing = None
+    if isinstance(first_listing, dict) and "results" not in first_listing:
+        yield first_listing
+        for line in source:
+            if line.strip():
+                yield json.loads(line)
+        return
+
+    # A single JSON document, possibly spread over several lines
+    document = first_listing if first_listing is not None else json.loads(first_line + source.read())
+    if isinstance(document, dict):
+        document = document["results"]
+    yield from document
+
+
+def dump_cards(cards: dict, card_data_file):
+    # Listings are written as rows in LISTING_FIELDS order and vendor listing maps as lists of rows, with no indentation
+    compact_cards = {}
+    for card_name, card_data in cards.items():
+        compact_card = dict(card_data)
+        compact_card["listings"] = [as_listing(listing).to_row() for listing in card_data.get("listings", {}).values()]
+        if "all_listings" in card_data:
+            compact_card["all_listings"] = [as_listing(listing).to_row() for listing in card_data["all_listings"]]
+        if "optimal_listing" in card_data:
+            compact_card["optimal_listing"] = as_listing(card_data["optimal_listing"]).to_row() if card_data["optimal_listing"] else None
+        if "offers" in card_data:
+            compact_card["offers"] = [as_listing(listing).to_row() for vendor_listings in card_data["offers"].values() for listing in vendor_listings]
+        if "purchases" in card_data:
+            compact_card["purchases"] = [[as_listing(listing).to_row(), copies] for listing, copies in card_data["purchases"]]
+        compact_cards[card_name] = compact_card
+    json.dump({"format": CARD_DATA_FORMAT, "listing_fields": LISTING_FIELDS, "cards": compact_cards}, card_data_file, separators=(',', ':'))
+
+
+def load_cards(card_data_file):
+    # Reads dump_cards output, and the older indented files holding raw Snapcaster dicts
+    # Rows from an older format lack the fields added since, which Listing gives defaults
+    document = json.load(card_data_file)
+    if "format" not in document:
+        for card_data in document.values():
+            card_data["listings"] = {vendor: Listing.from_snapcaster(listing) for vendor, listing in card_data.get("listings", {}).items()}
+            if "all_listings" in card_data:
+                card_data["all_listings"] = [Listing.from_snapcaster(listing) for listing in card_data["all_listings"]]
+            if card_data.get("optimal_listing"):
+                card_data["optimal_listing"] = Listing.from_snapcaster(card_data["optimal_listing"])
+        return document
+
+    cards = document["cards"]
+    for card_data in cards.values():
+        card_data["listings"] = {listing.vendor: listing for listing in map(Listing.from_row, card_data["listings"])}
+        if "all_listings" in card_data:
+            card_data["all_listings"] = [Listing.from_row(row) for row in card_data["all_listings"]]
+        if "optimal_listing" in card_data:
+            card_data["optimal_listing"] = Listing.from_row(card_data["optimal_listing"]) if card_data["optimal_listing"] else {}
+        if "offers" in card_data:
+            offers = {}
+            for listing in map(Listing.from_row, card_data["offers"]):
+                offers.setdefault(listing.vendor, []).append(listing)
+            card_data["offers"] = offers
+        if "purchases" in card_data:
+            card_data["purchases"] = [(Listing.from_row(row), copies) for row, copies in card_data["purchases"]]
+    return cards
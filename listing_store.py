@@ -0,0 +1,174 @@
+import json
+import sqlite3
+import threading
+import time
+from listing_pipeline import LISTING_FIELDS, Listing, as_listing, cheapest_per_vendor
+
+LISTING_STORE_PATH = "data/listings.sqlite"
+
+# Card data fields other than listings that are kept per run
+CARD_FIELDS = ("cardName", "isFoil", "cardSet", "scryfall_id", "quantity")
+
+LISTING_COLUMNS = ", ".join(f'"{field}"' for field in LISTING_FIELDS)
+
+
+class ListingStore:
+    # Every run's valid listings per card and vendor, and the assignment the optimizer picked, appended as they happen
+    def __init__(self, path: str = LISTING_STORE_PATH):
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            runs_existed = self.connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'runs'").fetchone() is not None
+            self.connection.executescript(f"""
+                CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, deck TEXT NOT NULL, started REAL NOT NULL, total_cost REAL,
+                                                 finished INTEGER NOT NULL DEFAULT 0);
+                CREATE INDEX IF NOT EXISTS runs_deck ON runs (deck, id);
+                CREATE TABLE IF NOT EXISTS cards (run_id INTEGER NOT NULL, card TEXT NOT NULL, scraped REAL NOT NULL, dropped INTEGER NOT NULL,
+                                                  data TEXT NOT NULL, stats TEXT, PRIMARY KEY (run_id, card));
+                CREATE TABLE IF NOT EXISTS listings (run_id INTEGER NOT NULL, card TEXT NOT NULL, scraped REAL NOT NULL, {LISTING_COLUMNS});
+                CREATE INDEX IF NOT EXISTS listings_run ON listings (run_id, card);
+                CREATE INDEX IF NOT EXISTS listings_history ON listings (card, vendor, scraped);
+                CREATE TABLE IF NOT EXISTS assignments (run_id INTEGER NOT NULL, card TEXT NOT NULL, vendor TEXT NOT NULL, price_cents INTEGER NOT NULL,
+                                                        PRIMARY KEY (run_id, card));
+                CREATE TABLE IF NOT EXISTS purchases (run_id INTEGER NOT NULL, card TEXT NOT NULL, vendor TEXT NOT NULL, variant_id TEXT NOT NULL,
+                                                      price_cents INTEGER NOT NULL, copies INTEGER NOT NULL);
+                CREATE INDEX IF NOT EXISTS purchases_run ON purchases (run_id, card);
+            """)
+            # Stores written before listings had a stock column or cards had filter stats
+            columns = {row[1] for row in self.connection.execute("PRAGMA table_info(listings)")}
+            for field in LISTING_FIELDS:
+                if field not in columns:
+                    self.connection.execute(f'ALTER TABLE listings ADD COLUMN "{field}"')
+            if "stats" not in {row[1] for row in self.connection.execute("PRAGMA table_info(cards)")}:
+                self.connection.execute("ALTER TABLE cards ADD COLUMN stats TEXT")
+            if runs_existed and "finished" not in {row[1] for row in self.connection.execute("PRAGMA table_info(runs)")}:
+                # Runs from before completion was recorded can't be told apart from interrupted ones, so none of them are resumed
+                self.connection.execute("ALTER TABLE runs ADD COLUMN finished INTEGER NOT NULL DEFAULT 0")
+                self.connection.execute("UPDATE runs SET finished = 1")
+                self.connection.commit()
+        return self.connection
+
+    def start_run(self, deck: str):
+        with self.lock:
+            connection = self._connect()
+            run_id = connection.execute("INSERT INTO runs (deck, started) VALUES (?, ?)", (deck, time.time())).lastrowid
+            connection.commit()
+            return run_id
+
+    def add_card(self, run_id: int, card_name: str, card_data: dict, dropped: bool = False, stats: dict | None = None):
+        # Replaces whatever this run already stored for the card. Multi-copy cards store every offer, which includes the cheapest listings.
+        scraped = time.time()
+        card_fields = {field: card_data[field] for field in CARD_FIELDS if field in card_data}
+        if card_data.get("offers"):
+            listings = [listing for offers in card_data["offers"].values() for listing in offers]
+        else:
+            listings = card_data.get("listings", {}).values()
+        listing_rows = [(run_id, card_name, scraped, *as_listing(listing).to_row()) for listing in listings]
+        with self.lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM listings WHERE run_id = ? AND card = ?", (run_id, card_name))
+            connection.execute("INSERT OR REPLACE INTO cards (run_id, card, scraped, dropped, data, stats) VALUES (?, ?, ?, ?, ?, ?)",
+                               (run_id, card_name, scraped, int(dropped), json.dumps(card_fields), json.dumps(stats) if stats is not None else None))
+            connection.executemany(f"INSERT INTO listings (run_id, card, scraped, {LISTING_COLUMNS}) VALUES ({', '.join('?' * (len(LISTING_FIELDS) + 3))})", listing_rows)
+            connection.commit()
+
+    def finish_run(self, run_id: int, total_cost: float | None, cards: dict):
+        # Records the optimal listing of every card that got one, and how many copies of which listings multi-copy cards buy
+        assignment_rows = [(run_id, card_name, card_data["optimal_listing"]["vendor"], as_listing(card_data["optimal_listing"]).price_cents)
+                           for card_name, card_data in cards.items() if card_data.get("optimal_listing")]
+        purchase_rows = [(run_id, card_name, listing["vendor"], str(listing["variant_id"]), as_listing(listing).price_cents, copies)
+                         for card_name, card_data in cards.items() for listing, copies in card_data.get("purchases", [])]
+        with self.lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM assignments WHERE run_id = ?", (run_id,))
+            connection.execute("DELETE FROM purchases WHERE run_id = ?", (run_id,))
+            connection.executemany("INSERT INTO assignments (run_id, card, vendor, price_cents) VALUES (?, ?, ?, ?)", assignment_rows)
+            connection.executemany("INSERT INTO purchases (run_id, card, vendor, variant_id, price_cents, copies) VALUES (?, ?, ?, ?, ?, ?)", purchase_rows)
+            connection.execute("UPDATE runs SET total_cost = ?, finished = 1 WHERE id = ?", (total_cost, run_id))
+            connection.commit()
+
+    def mark_finished(self, run_id: int):
+        # For runs that end without an optimization, e.g. a scrape-only run, so they are never resumed
+        with self.lock:
+            connection = self._connect()
+            connection.execute("UPDATE runs SET finished = 1 WHERE id = ?", (run_id,))
+            connection.commit()
+
+    def latest_run(self, deck: str, scraped_only: bool = True, before: int | None = None):
+        # Newest run of the deck, by default only one that got as far as storing cards, optionally older than the run before
+        with self.lock:
+            connection = self._connect()
+            query = "SELECT id FROM runs WHERE deck = ?"
+            parameters = [deck]
+            if scraped_only:
+                query += " AND EXISTS (SELECT 1 FROM cards WHERE run_id = runs.id)"
+            if before is not None:
+                query += " AND id < ?"
+                parameters.append(before)
+            row = connection.execute(query + " ORDER BY id DESC LIMIT 1", parameters).fetchone()
+        return row[0] if row else None
+
+    def run_finished(self, run_id: int):
+        # Whether the run completed, optimized or not, as opposed to being interrupted
+        with self.lock:
+            row = self._connect().execute("SELECT finished FROM runs WHERE id = ?", (run_id,)).fetchone()
+        return row is not None and bool(row[0])
+
+    def card_stats(self, run_id: int):
+        # {card: filter stats} for the cards of the run that were stored with them
+        with self.lock:
+            rows = self._connect().execute("SELECT card, stats FROM cards WHERE run_id = ? AND stats IS NOT NULL", (run_id,)).fetchall()
+        return {card_name: json.loads(stats) for card_name, stats in rows}
+
+    def scrape_times(self, run_id: int):
+        # {card: when it was last scraped} for the run
+        with self.lock:
+            return dict(self._connect().execute("SELECT card, scraped FROM cards WHERE run_id = ?", (run_id,)).fetchall())
+
+    def load_run(self, run_id: int):
+        # Cards as the scrape left them: card fields, {vendor: Listing}, {vendor: [Listing]} offers for multi-copy cards,
+        # and the optimal listing and purchases if the run was optimized
+        with self.lock:
+            connection = self._connect()
+            card_rows = connection.execute("SELECT card, dropped, data FROM cards WHERE run_id = ? ORDER BY rowid", (run_id,)).fetchall()
+            listing_rows = connection.execute(f"SELECT card, {LISTING_COLUMNS} FROM listings WHERE run_id = ? ORDER BY rowid", (run_id,)).fetchall()
+            assignment_rows = connection.execute("SELECT card, vendor FROM assignments WHERE run_id = ?", (run_id,)).fetchall()
+            purchase_rows = connection.execute("SELECT card, variant_id, copies FROM purchases WHERE run_id = ? ORDER BY rowid", (run_id,)).fetchall()
+
+        cards = {}
+        card_listings = {}
+        for card_name, dropped, data in card_rows:
+            cards[card_name] = {**json.loads(data), "dropped": bool(dropped)}
+            card_listings[card_name] = []
+        for card_name, *row in listing_rows:
+            card_listings[card_name].append(Listing.from_row(row))
+        for card_name, card_data in cards.items():
+            card_data["listings"] = cheapest_per_vendor(card_listings[card_name])
+            if card_data.get("quantity", 1) > 1:
+                card_data["offers"] = {}
+                for listing in card_listings[card_name]:
+                    card_data["offers"].setdefault(listing.vendor, []).append(listing)
+        for card_name, vendor in assignment_rows:
+            cards[card_name]["optimal_listing"] = cards[card_name]["listings"].get(vendor) or {}
+        for card_name, variant_id, copies in purchase_rows:
+            listing = next((listing for listing in card_listings[card_name] if str(listing.variant_id) == variant_id), None)
+            if listing is not None:
+                cards[card_name].setdefault("purchases", []).append((listing, copies))
+        return cards
+
+    def price_history(self, card_name: str, vendor: str | None = None, since: float | None = None):
+        # [(scraped, vendor, price_cents, condition)] oldest first
+        query = "SELECT scraped, vendor, price_cents, condition FROM listings WHERE card = ?"
+        parameters = [card_name]
+        if vendor is not None:
+            query += " AND vendor = ?"
+            parameters.append(vendor)
+        if since is not None:
+            query += " AND scraped >= ?"
+            parameters.append(since)
+        with self.lock:
+            return self._connect().execute(query + " ORDER BY scraped", parameters).fetchall()
@@ -0,0 +1,81 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the request latency and rate limit wait histogram buckets, the last bucket is everything above
+HISTOGRAM_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def new_histogram():
+    return {"count": 0, "total": 0.0, "max": 0.0, "buckets": [0] * (len(HISTOGRAM_BUCKETS) + 1)}
+
+
+def observe(histogram: dict, value: float):
+    histogram["count"] += 1
+    histogram["total"] += value
+    histogram["max"] = max(histogram["max"], value)
+    bucket = 0
+    while bucket < len(HISTOGRAM_BUCKETS) and value > HISTOGRAM_BUCKETS[bucket]:
+        bucket += 1
+    histogram["buckets"][bucket] += 1
+
+
+class Metrics:
+    # Phase spans and per-domain request timings for one run, shared by every worker thread
+    def __init__(self, start_time: float | None = None):
+        self.start_time = time.time() if start_time is None else start_time
+        self.spans = []
+        self.domains = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        span_start = time.time()
+        try:
+            yield attributes
+        finally:
+            self.record_span(name, span_start, time.time() - span_start, **attributes)
+
+    def record_span(self, name: str, span_start: float, duration: float, **attributes):
+        # For work timed elsewhere, e.g. in a worker process
+        with self.lock:
+            self.spans.append({"name": name, "start": round(span_start - self.start_time, 4), "duration": round(duration, 4),
+                               "thread": threading.current_thread().name, **attributes})
+
+    def record_request(self, domain: str | None, latency: float, wait: float, status: str):
+        # status is "network", "throttled" (answered with a 429/503 and retried), "hit" or "stale"
+        with self.lock:
+            domain_metrics = self.domains.get(domain)
+            if domain_metrics is None:
+                domain_metrics = {"statuses": {}, "latency": new_histogram(), "wait": new_histogram()}
+                self.domains[domain] = domain_metrics
+            domain_metrics["statuses"][status] = domain_metrics["statuses"].get(status, 0) + 1
+            observe(domain_metrics["latency"], latency)
+            observe(domain_metrics["wait"], wait)
+
+    def phase_totals(self):
+        totals = {}
+        with self.lock:
+            for span in self.spans:
+                phase = totals.setdefault(span["name"], {"count": 0, "total": 0.0, "max": 0.0})
+                phase["count"] += 1
+                phase["total"] += span["duration"]
+                phase["max"] = max(phase["max"], span["duration"])
+        return totals
+
+    def report(self, **run_info):
+        phases = self.phase_totals()
+        with self.lock:
+            return {"started": self.start_time, "duration": round(time.time() - self.start_time, 4),
+                    "histogram_buckets": list(HISTOGRAM_BUCKETS), **run_info, "phases": phases,
+                    "domains": json.loads(json.dumps(self.domains)), "spans": list(self.spans)}
+
+    def write_report(self, path: str, **run_info):
+        # One JSON object per line and per run, so runs can be compared over time
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'a') as report_file:
+            report_file.write(json.dumps(self.report(**run_info)) + "\n")
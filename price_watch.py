@@ -0,0 +1,258 @@
+import argparse
+import heapq
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import snapscraper
+from listing_pipeline import vendor_offers
+from listing_store import CARD_FIELDS
+from metrics import Metrics
+from retailer_selection import fee_tiers, listing_prices, store_fee
+
+# Seconds between scheduling cycles
+WATCH_INTERVAL = 60
+# Cards refreshed per cycle at most, each one costs at least one Snapcaster request
+REFRESH_BUDGET = 20
+
+# A card nothing makes interesting is refreshed this often, higher priorities divide it down to MIN_REFRESH_INTERVAL
+MAX_REFRESH_INTERVAL = 12 * 60 * 60
+MIN_REFRESH_INTERVAL = 30 * 60
+
+# Priority added for a card with a single vendor, shrinking as the card gains vendors
+FEW_VENDORS_WEIGHT = 3
+# Priority added for a card that is part of the current optimal assignment
+OPTIMAL_WEIGHT = 1
+# Priority added for a card bought from a store where one card more or less changes the shipping fee
+BREAKPOINT_WEIGHT = 2
+
+DEFAULT_FEES = {"0": 0, "1": 500}
+
+
+class PriceWatch:
+    # Keeps the listings of a set of decks fresh. Each card is refreshed on its own schedule, sooner when its price is
+    # more likely to change the optimal assignment, and a deck is re-optimized only when a refreshed price crosses the
+    # point where a different store would win the card.
+    def __init__(self, deck_urls: list[str], budget: int = REFRESH_BUDGET):
+        self.budget = budget
+        self.decks = {}  # deck id -> {"run_id", "cards", "optimized_cards", "cost", "store_items"}
+        self.card_decks = {}  # card name -> deck ids holding it
+        self.refreshed = {}  # card name -> when its listings were last scraped
+        self.due = {}  # card name -> when it should be refreshed next
+        self.queue = []  # (due, card name), entries that no longer match self.due are skipped
+        self.stop_event = threading.Event()
+        with open("data/websites.json", 'r') as websites_file:
+            self.store_fees = {store: website["fees"] for store, website in json.load(websites_file)["websites"].items()}
+        self.deck_ids = list(dict.fromkeys(snapscraper.deck_id_from_url(deck_url) for deck_url in deck_urls))
+
+    def log(self, level: str, message: str):
+        print(f"{time.time() - snapscraper.SCRIPT_START_TIME:.2f}s - {level} - [Price Watch] - {message}")
+
+    def load_decks(self):
+        # Starts from each deck's latest stored run, scraping the decks that were never scraped
+        for deck_id in self.deck_ids:
+            run_id = snapscraper.listing_store.latest_run(deck_id)
+            if run_id is None:
+                self.log("INFO", f"No stored scrape of '{deck_id}', scraping it first")
+                snapscraper.run(deck_id, ["scrape"])
+                run_id = snapscraper.listing_store.latest_run(deck_id)
+            stored_cards = snapscraper.listing_store.load_run(run_id)
+            scrape_times = snapscraper.listing_store.scrape_times(run_id)
+            cards = {card_name: card_data for card_name, card_data in stored_cards.items() if card_data["listings"] and not card_data["dropped"]}
+            self.decks[deck_id] = {"run_id": run_id, "cards": cards, "optimized_cards": None, "cost": None, "store_items": {}}
+            for card_name in cards:
+                self.card_decks.setdefault(card_name, []).append(deck_id)
+                self.refreshed[card_name] = min(self.refreshed.get(card_name, scrape_times[card_name]), scrape_times[card_name])
+            self.optimize(deck_id, stored_cards)
+        snapscraper.number_of_cards = len(self.card_decks)
+        for card_name in self.card_decks:
+            self.schedule(card_name)
+
+    def fees(self, store: str):
+        return self.store_fees.get(store, DEFAULT_FEES)
+
+    def fee_change(self, store: str, items: int, change: int):
+        # How much the store's shipping fee moves when it sells change more items
+        tiers = fee_tiers(self.fees(store), max(items, items + change, 1))
+        return store_fee(tiers, items + change) - store_fee(tiers, items)
+
+    def near_breakpoint(self, deck_id: str, store: str):
+        items = self.decks[deck_id]["store_items"].get(store, 0)
+        return self.fee_change(store, items, 1) != 0 or (items > 0 and self.fee_change(store, items, -1) != 0)
+
+    def priority(self, card_name: str):
+        # Highest over every deck holding the card
+        priority = 1
+        for deck_id in self.card_decks[card_name]:
+            card_data = self.decks[deck_id]["cards"][card_name]
+            deck_priority = 1 + FEW_VENDORS_WEIGHT / max(1, len(card_data["listings"]))
+            optimal_listing = card_data.get("optimal_listing")
+            if optimal_listing:
+                deck_priority += OPTIMAL_WEIGHT
+                if self.near_breakpoint(deck_id, optimal_listing["vendor"]):
+                    deck_priority += BREAKPOINT_WEIGHT
+            priority = max(priority, deck_priority)
+        return priority
+
+    def schedule(self, card_name: str):
+        due = self.refreshed[card_name] + max(MIN_REFRESH_INTERVAL, MAX_REFRESH_INTERVAL / self.priority(card_name))
+        if self.due.get(card_name) == due:
+            # Already queued for exactly then, a second entry would refresh it twice
+            return
+        self.due[card_name] = due
+        heapq.heappush(self.queue, (due, card_name))
+
+    def due_cards(self, now: float):
+        # The most overdue cards, up to the budget
+        cards = []
+        while self.queue and len(cards) < self.budget and self.queue[0][0] <= now:
+            due, card_name = heapq.heappop(self.queue)
+            if self.due.get(card_name) == due:
+                # Taken off the schedule until cycle() reschedules it after the refresh
+                del self.due[card_name]
+                cards.append(card_name)
+        return cards
+
+    def crosses_boundary(self, deck_id: str, card_data: dict, listings: dict):
+        # Whether the refreshed listings could make another store win the card. Moving it costs whatever one more item
+        # adds to the other store's shipping, nothing for most stores the order already ships from, and leaving the
+        # current store may lower that store's fee.
+        deck = self.decks[deck_id]
+        optimal_listing = card_data.get("optimal_listing")
+        if not optimal_listing:
+            return listing_prices(card_data["listings"]) != listing_prices(listings)
+        vendor = optimal_listing["vendor"]
+        if vendor not in listings:
+            return True
+        if card_data.get("quantity", 1) > 1:
+            # Copies can be split between stores, so any change at a store the card is bought from counts
+            purchased_vendors = {listing["vendor"] for listing, _ in card_data.get("purchases", [])} or {vendor}
+            if not purchased_vendors <= listings.keys():
+                return True
+            return any(listings[store]["price"] != card_data["listings"][store]["price"] for store in purchased_vendors if store in card_data["listings"])
+        leaving_saves = -self.fee_change(vendor, deck["store_items"].get(vendor, 0), -1)
+        price = listings[vendor]["price"]
+        for store, listing in listings.items():
+            if store == vendor:
+                continue
+            extra_fee = self.fee_change(store, deck["store_items"].get(store, 0), 1)
+            if 100 * listing["price"] + extra_fee < 100 * price + leaving_saves:
+                return True
+        return False
+
+    def refresh_card(self, card_num: int, card_name: str):
+        # Scrapes the card past the cache, returns its fresh listings, offers for the most copies any deck wants and
+        # every raw listing, or None if no listing survived
+        deck_card = self.decks[self.card_decks[card_name][0]]["cards"][card_name]
+        card_data = {field: deck_card[field] for field in CARD_FIELDS if field in deck_card}
+        card_data["quantity"] = max(self.decks[deck_id]["cards"][card_name].get("quantity", 1) for deck_id in self.card_decks[card_name])
+        stat_map = snapscraper.new_card_miss_stats([card_name])[card_name]
+        _, dropped = snapscraper.scrape_card(card_num, card_name, card_data, stat_map, force_refresh=True)
+        return None if dropped or not card_data["listings"] else card_data
+
+    def apply_refresh(self, card_name: str, fresh_data: dict):
+        # Updates every deck holding the card, returns the decks where the refresh crossed a decision boundary
+        crossed_decks = []
+        for deck_id in self.card_decks[card_name]:
+            deck = self.decks[deck_id]
+            card_data = deck["cards"][card_name]
+            if self.crosses_boundary(deck_id, card_data, fresh_data["listings"]):
+                crossed_decks.append(deck_id)
+            # A new dict, the optimized snapshot keeps the listings the last optimization saw. Only the listings are
+            # taken from the refresh, the card fields and quantity stay the deck's own.
+            card_data = {**card_data, "listings": fresh_data["listings"]}
+            if card_data.get("quantity", 1) > 1:
+                card_data["offers"] = vendor_offers(snapscraper.listing_filters.apply(card_name, fresh_data["all_listings"]), card_data["quantity"])
+            if card_data.get("optimal_listing") and deck_id not in crossed_decks:
+                card_data["optimal_listing"] = fresh_data["listings"][card_data["optimal_listing"]["vendor"]]
+            deck["cards"][card_name] = card_data
+        return crossed_decks
+
+    def optimize(self, deck_id: str, previous_cards: dict | None):
+        # Stores the deck's current cards as a new run and optimizes it
+        deck = self.decks[deck_id]
+        cards = deck["cards"]
+        run_id = snapscraper.listing_store.start_run(deck_id)
+        for card_name, card_data in cards.items():
+            snapscraper.listing_store.add_card(run_id, card_name, card_data)
+        retailer_names = {retailer for card_data in cards.values() for retailer in card_data["listings"]}
+        cost = snapscraper.optimize_deck(cards, retailer_names, previous_cards if snapscraper.INCREMENTAL_OPTIMIZE else None)
+        snapscraper.listing_store.finish_run(run_id, cost, cards)
+
+        store_items = {}
+        for card_data in cards.values():
+            for listing, copies in card_data.get("purchases") or ([(card_data["optimal_listing"], 1)] if card_data.get("optimal_listing") else []):
+                store_items[listing["vendor"]] = store_items.get(listing["vendor"], 0) + copies
+        if deck["cost"] is not None and cost != deck["cost"]:
+            self.log("INFO", f"'{deck_id}' - Total cost ${deck['cost']:.2f} -> ${cost:.2f}")
+        deck.update(run_id=run_id, cost=cost, store_items=store_items, optimized_cards={card_name: dict(card_data) for card_name, card_data in cards.items()})
+
+    def cycle(self):
+        # Returns how many cards were refreshed
+        card_names = self.due_cards(time.time())
+        if not card_names:
+            return 0
+        self.log("INFO", f"Refreshing {len(card_names)} cards, {sum(due <= time.time() for due in self.due.values())} more are due")
+        with ThreadPoolExecutor(max_workers=snapscraper.SCRAPE_CONCURRENCY) as executor:
+            fresh_cards = list(executor.map(self.refresh_card, range(1, len(card_names) + 1), card_names))
+
+        # Each cycle's refreshes go to a run of their own under "watch:<deck ids>", so the price history keeps every
+        # refresh while the decks' optimized runs are never rewritten. The decks take the fresh listings in memory.
+        watch_run = None
+        crossed_decks = set()
+        for card_name, fresh_data in zip(card_names, fresh_cards):
+            self.refreshed[card_name] = time.time()
+            if fresh_data is None:
+                self.log("WARNING", f"'{card_name}' - No valid listings on refresh, keeping the previous ones")
+                continue
+            if watch_run is None:
+                watch_run = snapscraper.listing_store.start_run("watch:" + "+".join(sorted(self.deck_ids)))
+            snapscraper.listing_store.add_card(watch_run, card_name, fresh_data)
+            card_crossed = self.apply_refresh(card_name, fresh_data)
+            if card_crossed:
+                self.log("INFO", f"'{card_name}' - Price change crossed a decision boundary in {', '.join(card_crossed)}")
+            crossed_decks.update(card_crossed)
+
+        if watch_run is not None:
+            snapscraper.listing_store.mark_finished(watch_run)
+        for deck_id in crossed_decks:
+            self.optimize(deck_id, self.decks[deck_id]["optimized_cards"])
+        # Reoptimized decks can change any of their cards' priorities
+        for card_name in {*card_names, *(card_name for deck_id in crossed_decks for card_name in self.decks[deck_id]["cards"])}:
+            self.schedule(card_name)
+
+        snapscraper.report_cache()
+        # A fresh Metrics per cycle, so a long running watch doesn't keep every span it ever recorded
+        snapscraper.metrics.write_report(snapscraper.METRICS_REPORT_PATH, decks=self.deck_ids, cards=len(card_names), stages=["watch"],
+                                         total_cost={deck_id: deck["cost"] for deck_id, deck in self.decks.items()},
+                                         rate_limits=snapscraper.rate_limiter.stats(), cache=snapscraper.request_session.stats())
+        snapscraper.metrics = Metrics()
+        return len(card_names)
+
+    def run(self, interval: float = WATCH_INTERVAL, max_cycles: int | None = None):
+        # Until stop() is called, the run is interrupted or max_cycles cycles have run
+        self.load_decks()
+        cycles = 0
+        try:
+            while not self.stop_event.is_set() and (max_cycles is None or cycles < max_cycles):
+                self.cycle()
+                cycles += 1
+                self.stop_event.wait(interval)
+        except KeyboardInterrupt:
+            pass
+        for deck_id, deck in self.decks.items():
+            self.log("INFO", f"'{deck_id}' - Total cost ${deck['cost']:.2f}")
+
+    def stop(self):
+        self.stop_event.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep the prices of a set of Moxfield decks fresh and re-optimize them when it matters")
+    parser.add_argument("decks", nargs="+", help="Moxfield deck ids or URLs")
+    parser.add_argument("--interval", type=float, default=WATCH_INTERVAL, help=f"Seconds between refresh cycles (default: {WATCH_INTERVAL})")
+    parser.add_argument("--budget", type=int, default=REFRESH_BUDGET, help=f"Cards refreshed per cycle at most (default: {REFRESH_BUDGET})")
+    parser.add_argument("--cycles", type=int, default=None, help="Stop after this many cycles instead of running until interrupted")
+    args = parser.parse_args()
+
+    PriceWatch(args.decks, args.budget).run(args.interval, args.cycles)
@@ -0,0 +1,147 @@
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+
+# A 429 without a Retry-After header still doubles the spacing, capped at this many seconds
+MAX_BACKOFF_INTERVAL = 60
+
+# Fraction of the extra spacing removed after each successful request
+BACKOFF_RECOVERY = 0.1
+
+
+class TokenBucket:
+    def __init__(self, min_time_between_requests: float, burst: int = 1):
+        self.base_interval = min_time_between_requests
+        self.interval = min_time_between_requests
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.refill_time = time.monotonic()
+        self.number_of_requests = 0
+        self.throttled_responses = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        # refill_time can sit in the future while a Retry-After block is active
+        if now <= self.refill_time:
+            return
+        if self.interval > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.refill_time) / self.interval)
+        else:
+            self.tokens = self.capacity
+        self.refill_time = now
+
+    def reserve(self, retry: bool = False):
+        # Takes a token (possibly going into debt) and returns how long the caller must wait for it, along with the
+        # backoff count it was reserved under. retry marks a reservation replacing one a backoff cancelled.
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            if not retry:
+                self.number_of_requests += 1
+            wait_time = max(0.0, self.refill_time - now)
+            if self.tokens < 0:
+                wait_time += -self.tokens * self.interval
+            return wait_time, self.throttled_responses
+
+    def still_valid(self, throttled_responses: int):
+        # False once a backoff happened after the reservation, its token was spaced for the old rate
+        with self.lock:
+            return self.throttled_responses == throttled_responses
+
+    def backoff(self, retry_after: float | None):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.throttled_responses += 1
+            self.interval = min(max(self.interval * 2, self.base_interval), MAX_BACKOFF_INTERVAL)
+            pause = retry_after if retry_after is not None else self.interval
+            # Nobody gets a new token until the server says so, then requests resume one at a time. Outstanding
+            # reservations are cancelled, their waiters reserve again once they wake up.
+            self.tokens = 1.0
+            self.refill_time = max(self.refill_time, now + pause)
+
+    def recover(self):
+        with self.lock:
+            if self.interval > self.base_interval:
+                self._refill(time.monotonic())
+                self.interval -= (self.interval - self.base_interval) * BACKOFF_RECOVERY
+
+
+class RateLimiter:
+    def __init__(self, rate_limits: dict, default_min_time: float):
+        self.default_min_time = default_min_time
+        self.buckets = {}
+        self.lock = threading.Lock()
+        for host, config in rate_limits.items():
+            self.configure(host, config["min_time_between_requests"], config.get("burst", 1))
+
+    def configure(self, host: str, min_time_between_requests: float, burst: int = 1):
+        with self.lock:
+            self.buckets[host] = TokenBucket(min_time_between_requests, burst)
+
+    def is_configured(self, host: str):
+        return host in self.buckets
+
+    def bucket(self, host: str):
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            with self.lock:
+                bucket = self.buckets.setdefault(host, TokenBucket(self.default_min_time))
+        return bucket
+
+    def acquire(self, host: str):
+        # Blocks for as long as the reservation requires. A backoff while sleeping cancels the reservation, so the
+        # request queues again behind the Retry-After block instead of going out inside it. Returns the total wait.
+        bucket = self.bucket(host)
+        wait_time, throttled_responses = bucket.reserve()
+        total_wait = wait_time
+        while wait_time > 0:
+            time.sleep(wait_time)
+            if bucket.still_valid(throttled_responses):
+                break
+            wait_time, throttled_responses = bucket.reserve(retry=True)
+            total_wait += wait_time
+        return total_wait
+
+    def report_response(self, host: str, response):
+        # Returns True when the server asked us to slow down and the request should be retried
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        if response.status_code == 429 or (response.status_code == 503 and retry_after is not None):
+            self.bucket(host).backoff(retry_after)
+            return True
+        self.bucket(host).recover()
+        return False
+
+    def stats(self):
+        return {host: {"number_of_requests": bucket.number_of_requests,
+                       "throttled_responses": bucket.throttled_responses,
+                       "min_time_between_requests": bucket.interval}
+                for host, bucket in self.buckets.items()}
+
+
+def host_from_url(url: str):
+    _, separator, remainder = url.partition("://")
+    if not separator:
+        return None
+    return _host_from_authority(remainder.split("/", 1)[0].split("?", 1)[0])
+
+
+@lru_cache(maxsize=1024)
+def _host_from_authority(authority: str):
+    host = authority.rsplit("@", 1)[-1].split(":", 1)[0].lower()
+    return host or None
+
+
+def parse_retry_after(value: str | None):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
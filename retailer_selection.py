@@ -1,21 +1,399 @@
 import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from ortools.sat.python import cp_model
 
-def process(moxfield_cards: dict, stores: set[str]):
-    card_names = list(moxfield_cards.keys())
+
+class ImprovingSolutionLogger(cp_model.CpSolverSolutionCallback):
+    # Called by the solver every time it finds a better assignment
+    def __init__(self, label: str = ""):
+        super().__init__()
+        self.label = label
+        self.solution_count = 0
+
+    def on_solution_callback(self):
+        self.solution_count += 1
+        objective = self.ObjectiveValue()
+        bound = self.BestObjectiveBound()
+        gap = 100 * (objective - bound) / objective if objective else 0
+        print(f"{self.WallTime():.2f}s - {self.label}Solution {self.solution_count}: ${objective/100:.2f}, bound ${bound/100:.2f}, gap {gap:.2f}%")
+
+
+def fee_tiers(fees: dict[str, int], max_items: int):
+    # websites.json maps the item count where a fee starts applying to the fee, e.g. {"0": 0, "1": 300, "6": 500}
+    breakpoints = sorted((int(items), fee) for items, fee in fees.items())
+    if breakpoints[0][0] > 0:
+        breakpoints.insert(0, (0, 0))
+    tiers = []  # (lowest item count, highest item count, fee)
+    for index, (lower, fee) in enumerate(breakpoints):
+        if lower > max_items:
+            break
+        upper = breakpoints[index + 1][0] - 1 if index + 1 < len(breakpoints) else max_items
+        tiers.append((lower, min(upper, max_items), fee))
+    return tiers
+
+def store_fee(tiers: list[tuple[int, int, int]], items: int):
+    for lower, upper, tier_fee in tiers:
+        if lower <= items <= upper:
+            return tier_fee
+    return tiers[-1][2]
+
+def assignment_cost(assignment: list[int], cost_matrix: list[dict[int, int]], store_tiers: list[list[tuple[int, int, int]]]):
+    items_from_store = [0 for tiers in store_tiers]
+    total = 0
+    for c, s in enumerate(assignment):
+        items_from_store[s] += 1
+        total += cost_matrix[c][s]
+    return total + sum(store_fee(tiers, items) for tiers, items in zip(store_tiers, items_from_store))
+
+def dominated_stores(cost_matrix: list[dict[int, int]], store_cards: list[list[int]], store_tiers: list[list[tuple[int, int, int]]]):
+    # Store a is dominated by store b when b sells every card a sells for no more, and b's highest fee for a
+    # non-empty order is no more than a's lowest. Moving all of a's cards to b can then never cost more.
+    removed = set()
+    order_fees = [[tier_fee for _, upper, tier_fee in tiers if upper >= 1] for tiers in store_tiers]
+    for a in range(len(store_cards)):
+        if not store_cards[a] or min(order_fees[a]) < 0:
+            continue
+        for b in range(len(store_cards)):
+            if b == a or b in removed or len(store_cards[b]) < len(store_cards[a]):
+                continue
+            if max(order_fees[b]) > min(order_fees[a]):
+                continue
+            if all(b in cost_matrix[c] and cost_matrix[c][b] <= cost_matrix[c][a] for c in store_cards[a]):
+                removed.add(a)
+                break
+    return removed
+
+def greedy_assignment(cost_matrix: list[dict[int, int]], store_tiers: list[list[tuple[int, int, int]]], max_passes: int = 50, start: list[int | None] | None = None):
+    # Start every card at its cheapest store (or where `start` puts it, if that store still sells it), then move
+    # single cards and empty out whole stores while that lowers the total
+    fee_table = [[store_fee(tiers, items) for items in range(tiers[-1][1] + 2)] for tiers in store_tiers]
+    assignment = [min(prices, key=lambda s: (prices[s], s)) for prices in cost_matrix]
+    if start is not None:
+        assignment = [s if s in prices else cheapest for prices, s, cheapest in zip(cost_matrix, start, assignment)]
+    items_from_store = [0 for tiers in store_tiers]
+    for s in assignment:
+        items_from_store[s] += 1
+
+    def move_delta(c, to_store):
+        from_store = assignment[c]
+        return (cost_matrix[c][to_store] - cost_matrix[c][from_store]
+                + fee_table[from_store][items_from_store[from_store] - 1] - fee_table[from_store][items_from_store[from_store]]
+                + fee_table[to_store][items_from_store[to_store] + 1] - fee_table[to_store][items_from_store[to_store]])
+
+    def move(c, to_store):
+        items_from_store[assignment[c]] -= 1
+        items_from_store[to_store] += 1
+        assignment[c] = to_store
+
+    for _ in range(max_passes):
+        improved = False
+        for c, prices in enumerate(cost_matrix):
+            best_store, best_delta = None, 0
+            for s in prices:
+                if s != assignment[c]:
+                    delta = move_delta(c, s)
+                    if delta < best_delta:
+                        best_store, best_delta = s, delta
+            if best_store is not None:
+                move(c, best_store)
+                improved = True
+
+        for closing_store in range(len(store_tiers)):
+            cards = [c for c, s in enumerate(assignment) if s == closing_store]
+            if not cards or any(len(cost_matrix[c]) == 1 for c in cards):
+                continue
+            total_delta = 0
+            moved = []
+            for c in cards:
+                to_store = min((s for s in cost_matrix[c] if s != closing_store), key=lambda s: (move_delta(c, s), s))
+                total_delta += move_delta(c, to_store)
+                moved.append(c)
+                move(c, to_store)
+            if total_delta < 0:
+                improved = True
+            else:
+                for c in moved:
+                    move(c, closing_store)
+
+        if not improved:
+            break
+    return assignment
+
+def card_components(cost_matrix: list[dict[int, int]], store_tiers: list[list[tuple[int, int, int]]]):
+    # Cards are only tied together by stores that charge shipping, a store that never charges
+    # can't make buying one card there depend on any other. Union-find over the remaining stores.
+    parent = list(range(len(cost_matrix)))
+
+    def find(c):
+        while parent[c] != c:
+            parent[c] = parent[parent[c]]
+            c = parent[c]
+        return c
+
+    first_card_at_store = {}
+    for c, prices in enumerate(cost_matrix):
+        for s in prices:
+            if all(tier_fee == 0 for _, _, tier_fee in store_tiers[s]):
+                continue
+            if s in first_card_at_store:
+                parent[find(c)] = find(first_card_at_store[s])
+            else:
+                first_card_at_store[s] = c
+
+    components = {}
+    for c in range(len(cost_matrix)):
+        components.setdefault(find(c), []).append(c)
+    return list(components.values())
+
+def add_store_fee(model: cp_model.CpModel, s: int, num_items, tiers: list[tuple[int, int, int]], max_items: int, hint_items: int):
+    # Returns the fee variable of store s for num_items bought there.
+    # One indicator per shipping tier the store can reach, the active tier picks the fee.
+    tier_active = []
+    for lower, upper, tier_fee in tiers:
+        if lower > max_items:
+            break
+        condition = model.NewBoolVar(f"items_{lower}_to_{upper}_from_{s}")
+        model.Add(num_items >= lower).OnlyEnforceIf(condition)
+        model.Add(num_items <= upper).OnlyEnforceIf(condition)
+        model.AddHint(condition, lower <= hint_items <= upper)
+        tier_active.append(condition)
+    tiers = tiers[:len(tier_active)]
+    model.AddExactlyOne(tier_active)
+    # Same bounds as a linear sum over the tiers, redundant but it gives the LP relaxation something to work with
+    model.Add(num_items >= sum(condition * lower for condition, (lower, _, _) in zip(tier_active, tiers)))
+    model.Add(num_items <= sum(condition * upper for condition, (_, upper, _) in zip(tier_active, tiers)))
+
+    tier_fees = [tier_fee for _, _, tier_fee in tiers]
+    fee = model.NewIntVar(min(tier_fees), max(tier_fees), f"fee[{s}]")
+    model.Add(fee == sum(condition * tier_fee for condition, tier_fee in zip(tier_active, tier_fees)))
+    model.AddHint(fee, store_fee(tiers, hint_items))
+    return fee
+
+def solve_assignment(cost_matrix: list[dict[int, int]], store_tiers: list[list[tuple[int, int, int]]], time_limit: float | None = None, num_workers: int = 0, label: str = "", previous_assignment: list[int | None] | None = None, timings: dict | None = None):
+    # Picks a store for every card, returns the store index per card or None if the model is infeasible.
+    # Only takes plain lists and dicts so it can run in a worker process.
+    # previous_assignment seeds the warm start, None entries are cards that had no store last time.
+    # timings, if given, is filled with the start time and seconds spent on "model_build" and "solve".
+    build_start = time.time()
+    all_cards = range(len(cost_matrix))
+    store_cards = [[] for tiers in store_tiers]  # Cards each store carries
+    for c, prices in enumerate(cost_matrix):
+        for s in prices:
+            store_cards[s].append(c)
+    fixed_cards = {c: next(iter(prices)) for c, prices in enumerate(cost_matrix) if len(prices) == 1}
+
+    # Warm start: a cheap local search usually lands on or near the optimum
+    warm_start = greedy_assignment(cost_matrix, store_tiers)
+    if previous_assignment is not None:
+        # Last run's answer, patched up where a store stopped selling a card, is usually the better starting point
+        from_previous = greedy_assignment(cost_matrix, store_tiers, start=previous_assignment)
+        if assignment_cost(from_previous, cost_matrix, store_tiers) <= assignment_cost(warm_start, cost_matrix, store_tiers):
+            warm_start = from_previous
+    if len(fixed_cards) == len(cost_matrix):
+        return warm_start
+    warm_start_counts = [0 for tiers in store_tiers]
+    for s in warm_start:
+        warm_start_counts[s] += 1
+
+    # Create Model
+    model = cp_model.CpModel()
+
+    # Variables
+
+    # y[c, s] = 1 if card `c` is bought from store `s`, else 0. Only pairs with a listing get a variable,
+    # cards sold by a single store have none.
+    y = {}
+    for c in all_cards:
+        if c in fixed_cards:
+            continue
+        for s in cost_matrix[c]:
+            y[(c, s)] = model.NewBoolVar(f"y[{c},{s}]")
+            model.AddHint(y[(c, s)], warm_start[c] == s)
+
+    fixed_items_from_store = [0 for tiers in store_tiers]
+    for s in fixed_cards.values():
+        fixed_items_from_store[s] += 1
+
+    # Number of items ordered from each store
+    # Fee variables for each store (depends on the number of items)
+    num_items_from_store = {}
+    fee = {}
+    for s, tiers in enumerate(store_tiers):
+        if not store_cards[s]:
+            continue
+        max_items = len(store_cards[s])
+
+        # Number of items bought from each store
+        num_items_from_store[s] = model.NewIntVar(fixed_items_from_store[s], max_items, f"num_items_from_store[{s}]")
+        model.Add(num_items_from_store[s] == fixed_items_from_store[s] + sum(y[(c, s)] for c in store_cards[s] if c not in fixed_cards))
+        model.AddHint(num_items_from_store[s], warm_start_counts[s])
+        fee[s] = add_store_fee(model, s, num_items_from_store[s], tiers, max_items, warm_start_counts[s])
+
+    # Constraints
+    # Each card is assigned to exactly one store.
+    for c in all_cards:
+        if c not in fixed_cards:
+            model.Add(sum(y[(c, s)] for s in cost_matrix[c]) == 1)
+
+    # Objective
+    obj_expr = []
+
+    # Add product costs to the objective
+    for (c, s), bought in y.items():
+        obj_expr.append(bought * cost_matrix[c][s])
+    fixed_cost = sum(cost_matrix[c][s] for c, s in fixed_cards.items())
+
+    # Add the tiered order processing fees to the objective
+    for s in fee:
+        obj_expr.append(fee[s])
+
+    model.Minimize(sum(obj_expr) + fixed_cost)
+
+    solver, status = run_solver(model, time_limit, num_workers, label, build_start, timings)
+    if status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+        assignment = list(warm_start)
+        for (c, s), bought in y.items():
+            if solver.Value(bought) == 1:
+                assignment[c] = s
+        return assignment
+    if status == cp_model.UNKNOWN:
+        return warm_start
+    return None
+
+def run_solver(model: cp_model.CpModel, time_limit: float | None, num_workers: int, label: str, build_start: float, timings: dict | None):
+    solve_start = time.time()
+    if timings is not None:
+        timings["model_build"] = (build_start, solve_start - build_start)
+
+    # Creates the solver and solve.
+    solver = cp_model.CpSolver()
+    solver.parameters.num_workers = num_workers or os.cpu_count() or 1
+    if time_limit is not None:
+        solver.parameters.max_time_in_seconds = time_limit
+    status = solver.Solve(model, ImprovingSolutionLogger(label))
+    if timings is not None:
+        timings["solve"] = (solve_start, time.time() - solve_start)
+
+    if status == cp_model.FEASIBLE:
+        gap = 100 * (solver.ObjectiveValue() - solver.BestObjectiveBound()) / solver.ObjectiveValue() if solver.ObjectiveValue() else 0
+        print(f"{label}Time limit reached after {solver.WallTime():.2f}s, using best assignment found ({gap:.2f}% from the bound)")
+    elif status == cp_model.UNKNOWN:
+        # The warm start is always feasible, so running out of time never leaves us empty handed
+        print(f"{label}Time limit reached after {solver.WallTime():.2f}s before the solver found a solution, using the warm start")
+    return solver, status
+
+def greedy_quantities(offers: list[dict[int, list[tuple[int, int]]]], quantities: list[int]):
+    # Cheapest copies first for every card, ignoring shipping
+    purchase = []
+    for card_offers, quantity in zip(offers, quantities):
+        units = {s: [0 for offer in store_offers] for s, store_offers in card_offers.items()}
+        remaining = quantity
+        for price, s, k, capacity in sorted((price, s, k, capacity) for s, store_offers in card_offers.items() for k, (price, capacity) in enumerate(store_offers)):
+            if not remaining:
+                break
+            units[s][k] = min(capacity, remaining)
+            remaining -= units[s][k]
+        purchase.append(units)
+    return purchase
+
+def purchase_items(purchase: list[dict[int, list[int]]], num_stores: int):
+    items_from_store = [0 for s in range(num_stores)]
+    for card_units in purchase:
+        for s, offer_units in card_units.items():
+            items_from_store[s] += sum(offer_units)
+    return items_from_store
+
+def solve_quantities(offers: list[dict[int, list[tuple[int, int]]]], quantities: list[int], store_tiers: list[list[tuple[int, int, int]]], time_limit: float | None = None, num_workers: int = 0, label: str = "", timings: dict | None = None):
+    # Integer version of solve_assignment for cards needed several times. offers[c][s] holds the (price, copies in stock)
+    # of each listing of card c at store s, cheapest first, and quantities[c] copies are bought in total.
+    # Returns the copies bought per listing as {s: [copies per offer]} per card, or None if the model is infeasible.
+    build_start = time.time()
+    warm_start = greedy_quantities(offers, quantities)
+    warm_start_counts = purchase_items(warm_start, len(store_tiers))
+
+    model = cp_model.CpModel()
+
+    # x[c, s, k] = copies of card c bought through listing k of store s. The model grows with the number of listings,
+    # not with the number of copies.
+    x = {}
+    units_from_store = [[] for tiers in store_tiers]
+    max_items = [0 for tiers in store_tiers]
+    for c, card_offers in enumerate(offers):
+        for s, store_offers in card_offers.items():
+            for k, (price, capacity) in enumerate(store_offers):
+                x[(c, s, k)] = model.NewIntVar(0, capacity, f"x[{c},{s},{k}]")
+                model.AddHint(x[(c, s, k)], warm_start[c][s][k])
+                units_from_store[s].append(x[(c, s, k)])
+            max_items[s] += min(quantities[c], sum(capacity for _, capacity in store_offers))
+        model.Add(sum(x[(c, s, k)] for s, store_offers in card_offers.items() for k in range(len(store_offers))) == quantities[c])
+
+    fee = {}
+    for s, tiers in enumerate(store_tiers):
+        if not units_from_store[s]:
+            continue
+        num_items_from_store = model.NewIntVar(0, max_items[s], f"num_items_from_store[{s}]")
+        model.Add(num_items_from_store == sum(units_from_store[s]))
+        model.AddHint(num_items_from_store, warm_start_counts[s])
+        fee[s] = add_store_fee(model, s, num_items_from_store, tiers, max_items[s], warm_start_counts[s])
+
+    model.Minimize(sum(units * offers[c][s][k][0] for (c, s, k), units in x.items()) + sum(fee.values()))
+
+    solver, status = run_solver(model, time_limit, num_workers, label, build_start, timings)
+    if status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+        return [{s: [solver.Value(x[(c, s, k)]) for k in range(len(store_offers))] for s, store_offers in card_offers.items()}
+                for c, card_offers in enumerate(offers)]
+    if status == cp_model.UNKNOWN:
+        return warm_start
+    return None
+
+def timed_solve_assignment(*args, deadline: float | None = None, **kwargs):
+    # solve_assignment for worker processes, which can't fill in a timings dict owned by the parent.
+    # deadline (a time.time()) sets the time limit to whatever is left of it when the job actually starts,
+    # so jobs queued behind others in the pool still finish by it.
+    if deadline is not None:
+        kwargs["time_limit"] = max(0.0, deadline - time.time())
+    timings = {}
+    return solve_assignment(*args, **kwargs, timings=timings), timings
+
+def listing_prices(listings: dict):
+    return {store: listing["price"] for store, listing in listings.items()}
+
+def changed_cards(moxfield_cards: dict, previous_cards: dict, card_names: list[str]):
+    # Cards that are new, or whose stores or prices differ from the previous run
+    changed = []
+    for card_name in card_names:
+        previous = previous_cards.get(card_name)
+        if not previous or listing_prices(previous.get("listings", {})) != listing_prices(moxfield_cards[card_name]["listings"]):
+            changed.append(card_name)
+    return changed
+
+def process(moxfield_cards: dict, stores: set[str], time_limit: float | None = None, num_workers: int = 0, previous_cards: dict | None = None, metrics=None):
+    # time_limit is in seconds, once it runs out the best assignment found so far is used.
+    # num_workers = 0 runs one search worker per core.
+    # previous_cards is the data file written by an earlier run of the same deck, its optimal_listing
+    # entries are reused outright if nothing changed and seed the solver otherwise.
+    # metrics (a metrics.Metrics) receives presolve, model_build and solve spans.
     card_name_list = []  # List of card names on their own
     card_name_index = {}  # Maps card names to their index in card_name_list
-    for index, card_name in enumerate(card_names):
+    for card_name, card_data in moxfield_cards.items():
+        if not any(store in stores for store in card_data["listings"]):
+            # Nothing to choose between, the model would be infeasible with this card in it
+            print(f"No listings found for card: {card_name}")
+            continue
+        card_name_index[card_name] = len(card_name_list)
         card_name_list.append(card_name)
-        card_name_index[card_name] = index
 
     # Shipping cost (initially set to 2, but will depend on the number of items)
     with open("data/websites.json", 'r') as inFile:
         shipping_cost_map = json.load(inFile)["websites"]
 
+    # Only stores that carry at least one of the cards are modeled
+    carried_stores = {store for card_name in card_name_list for store in moxfield_cards[card_name]["listings"] if store in stores}
     store_name_list = []  # List of store names on their own
     store_name_index = {}  # Maps store names to their index in store_name_list
-    for index, store_name in enumerate(stores):
+    for index, store_name in enumerate(sorted(carried_stores)):
         store_name_list.append(store_name)
         store_name_index[store_name] = index
         if store_name not in shipping_cost_map:
@@ -26,125 +404,191 @@ def process(moxfield_cards: dict, stores: set[str]):
                 "fees": {
                     "0": 0,
                     "1": 500
-                },
-                "fee_array": []
+                }
             }
 
+    if any(moxfield_cards[card_name].get("quantity", 1) > 1 for card_name in card_name_list):
+        return process_quantities(moxfield_cards, card_name_list, store_name_list, store_name_index, shipping_cost_map, time_limit, num_workers, metrics)
+
     num_cards = len(card_name_list)
     all_cards = range(num_cards)
 
     num_stores = len(store_name_list)
     all_stores = range(num_stores)
 
-    for cardsOrdered in range(num_cards+1):
-        for store in store_name_list:
-            store_shipping = shipping_cost_map[store]
-            if str(cardsOrdered) in store_shipping["fees"]:
-                shipFee = store_shipping["fees"][str(cardsOrdered)]
-            else:
-                shipFee = store_shipping["fee_array"][-1]
-            store_shipping["fee_array"].append(shipFee)
-
-    min_shipping_fee = None
-    max_shipping_fee = None
-    for store in store_name_list:
-        store_fees = shipping_cost_map[store]["fee_array"]
-        min_fee = min(store_fees)
-        max_fee = max(store_fees)
-        min_shipping_fee = min_fee if min_shipping_fee is None else min(min_shipping_fee, min_fee)  
-        max_shipping_fee = max_fee if max_shipping_fee is None else max(max_shipping_fee, max_fee)
-
-    # Cost matrix: contains the price of each card at each store
-    cost_matrix = [[] for card in card_name_list]  # Values are the prices for the card at store based on list index
-    for card_name, index in card_name_index.items():
-        for store in store_name_list:
-            if store in moxfield_cards[card_name]["listings"]:
-                cost_matrix[index].append(round(100 * moxfield_cards[card_name]["listings"][store]["price"]))
-            else:
-                cost_matrix[index].append(10000000)
-
+    # Cost matrix: price in cents of each card at each store that carries it
+    cost_matrix = [{} for card in card_name_list]
+    store_cards = [[] for store in store_name_list]  # Cards each store carries
+    for card_name, c in card_name_index.items():
+        for store, listing in moxfield_cards[card_name]["listings"].items():
+            if store in store_name_index:
+                s = store_name_index[store]
+                cost_matrix[c][s] = round(100 * listing["price"])
+                store_cards[s].append(c)
 
+    store_tiers = [fee_tiers(shipping_cost_map[store_name_list[s]]["fees"], len(store_cards[s])) for s in all_stores]
 
-    # Create Model
-    model = cp_model.CpModel()
+    assignment = None
+    previous_assignment = None
+    if previous_cards is not None:
+        previous_assignment = []
+        for card_name in card_name_list:
+            previous_listing = previous_cards.get(card_name, {}).get("optimal_listing") or {}
+            previous_assignment.append(store_name_index.get(previous_listing.get("vendor")))
+        changed = changed_cards(moxfield_cards, previous_cards, card_name_list)
+        removed_cards = [card_name for card_name, card_data in previous_cards.items() if card_data.get("optimal_listing") and card_name not in card_name_index]
+        if not changed and not removed_cards and None not in previous_assignment:
+            print("No listings changed since the last run, reusing its assignment")
+            assignment = previous_assignment
+        else:
+            print(f"{len(changed)} cards changed and {len(removed_cards)} were removed since the last run, re-solving from the previous assignment")
 
-    # Variables
+    if assignment is None:
+        # Presolve: drop stores another store beats on every card and on shipping, then fix cards left with one store
+        presolve_start = time.time()
+        removed_stores = dominated_stores(cost_matrix, store_cards, store_tiers)
+        for s in removed_stores:
+            for c in store_cards[s]:
+                del cost_matrix[c][s]
+            store_cards[s] = []
+        num_fixed_cards = sum(1 for prices in cost_matrix if len(prices) == 1)
+        print(f"Presolve removed {len(removed_stores)} dominated stores and fixed {num_fixed_cards} cards sold by a single store")
 
-    # y[c, s] = 1 if card `c` is bought from store `s`, else 0
-    y = {}
-    for c in all_cards:
-        for s in all_stores:
-            y[(c, s)] = model.NewBoolVar(f"y[{card_name_list[c]},{store_name_list[s]}]")
+        # Split into groups of cards that share no store with shipping fees and solve each group on its own
+        components = card_components(cost_matrix, store_tiers)
+        print(f"Split {num_cards} cards into {len(components)} independent groups, largest has {max((len(component) for component in components), default=0)} cards")
+        sub_problems = []
+        for component in components:
+            component_stores = sorted({s for c in component for s in cost_matrix[c]})
+            local_store_index = {s: index for index, s in enumerate(component_stores)}
+            local_cost_matrix = [{local_store_index[s]: price for s, price in cost_matrix[c].items()} for c in component]
+            local_previous = None if previous_assignment is None else [local_store_index.get(previous_assignment[c]) for c in component]
+            sub_problems.append((component, component_stores, local_cost_matrix, [store_tiers[s] for s in component_stores], local_previous))
 
-    # Number of items ordered from each store
-    # Fee variables for each store (depends on the number of items)
-    num_items_from_store = {}
-    fee = {}
-    for s in all_stores:
-        store_name = store_name_list[s]
+        if metrics is not None:
+            metrics.record_span("presolve", presolve_start, time.time() - presolve_start, groups=len(components))
 
-        # Number of items bought from each store
-        num_items_from_store[s] = model.NewIntVar(0, num_cards, f"num_items_from_store[{store_name}]")
-        model.Add(num_items_from_store[s] == sum(y[(c, s)] for c in all_cards))
-        
-        # Get the fee structure for this store from the shipping_cost_map
-        fee[s] = model.NewIntVar(min_shipping_fee, max_shipping_fee, f"fee[{store_name}]")
-        fees = shipping_cost_map[store_name]["fee_array"]
-        
-        # Apply the fees based on the number of items ordered
-        for i in range(0, num_cards+1):
-            condition = model.NewBoolVar(f"items_{i}_from_{store_name}")
-            model.Add(num_items_from_store[s] == i).OnlyEnforceIf(condition)
-            model.Add(num_items_from_store[s] != i).OnlyEnforceIf(condition.Not())
-            shipping_fee = fees[-1]
-            if i < len(fees):
-                shipping_fee = fees[i]
-            model.Add(fee[s] == shipping_fee).OnlyEnforceIf(condition)
+        # Groups with a single card are just the cheapest price plus first-item fee, the rest go to the solver
+        large_problems = [index for index, (component, _, _, _, _) in enumerate(sub_problems) if len(component) > 1]
+        solutions = [greedy_assignment(local_cost_matrix, local_tiers) if len(component) == 1 else None
+                     for component, _, local_cost_matrix, local_tiers, _ in sub_problems]
+        if len(large_problems) == 1:
+            _, _, local_cost_matrix, local_tiers, local_previous = sub_problems[large_problems[0]]
+            solutions[large_problems[0]], solve_timings = timed_solve_assignment(local_cost_matrix, local_tiers, time_limit, num_workers, previous_assignment=local_previous)
+            solve_timings = {large_problems[0]: solve_timings}
+        elif large_problems:
+            total_workers = num_workers or os.cpu_count() or 1
+            pool_size = min(len(large_problems), total_workers)
+            workers_per_problem = max(1, total_workers // pool_size)
+            # One time budget for every group together, the pool may have to run them a few at a time
+            deadline = None if time_limit is None else time.time() + time_limit
+            with ProcessPoolExecutor(max_workers=pool_size) as executor:
+                futures = {index: executor.submit(timed_solve_assignment, sub_problems[index][2], sub_problems[index][3], num_workers=workers_per_problem,
+                                                  label=f"[Group {index + 1}/{len(sub_problems)}] ", previous_assignment=sub_problems[index][4], deadline=deadline)
+                           for index in large_problems}
+                solve_timings = {}
+                for index, future in futures.items():
+                    solutions[index], solve_timings[index] = future.result()
+        else:
+            solve_timings = {}
+        if metrics is not None:
+            for index, timings in solve_timings.items():
+                for phase, (phase_start, duration) in timings.items():
+                    metrics.record_span(phase, phase_start, duration, group=index + 1, cards=len(sub_problems[index][0]))
+        if any(solution is None for solution in solutions):
+            return -1
 
+        assignment = [None for card in card_name_list]
+        for (component, component_stores, _, _, _), solution in zip(sub_problems, solutions):
+            for c, local_store in zip(component, solution):
+                assignment[c] = component_stores[local_store]
 
-    # Constraints
-    # Each card is assigned to exactly one store.
     for c in all_cards:
-        model.Add(sum(y[(c, s)] for s in all_stores) == 1)
+        store = store_name_list[assignment[c]]
+        card = card_name_list[c]
+        moxfield_cards[card]["optimal_listing"] = moxfield_cards[card]["listings"][store]
+        print(f"Buy {card} from {store} for: ${moxfield_cards[card]['listings'][store]['price']}")
+    total_shipping = 0
+    for s in all_stores:
+        store = store_name_list[s]
+        cards_bought = [c for c in store_cards[s] if assignment[c] == s]
+        if cards_bought:
+            store_shipping = store_fee(store_tiers[s], len(cards_bought))
+            print(f"Bought {len(cards_bought)} cards from {store}: ${sum(cost_matrix[c][s] for c in cards_bought)/100:.2f} + ${store_shipping/100:.2f} in fees")
+            total_shipping += store_shipping
+    total_cost = assignment_cost(assignment, cost_matrix, store_tiers)
+    print(f"Optimized Total Cost: ${(total_cost-total_shipping)/100:.2f} + ${total_shipping/100:.2f} in fees")
 
-    # Objective
-    obj_expr = []
+    return total_cost/100
 
-    # Add product costs to the objective
-    for c in all_cards:
-        for s in all_stores:
-            obj_expr.append(y[(c, s)] * cost_matrix[c][s])
+def process_quantities(moxfield_cards: dict, card_name_list: list[str], store_name_list: list[str], store_name_index: dict, shipping_cost_map: dict, time_limit: float | None = None, num_workers: int = 0, metrics=None):
+    # process() for decks with cards needed several times. Every listing in a card's "offers" (cheapest first per
+    # vendor) can be bought up to its stock, unknown stock counts as enough. Sets "purchases" to [(listing, copies)]
+    # and "optimal_listing" to the listing most copies come from. Presolve, the split into groups and
+    # incremental reuse only apply to single-copy decks.
+    offers = []  # Per card, {store: [(price in cents, copies available)]}
+    offer_listings = []  # Per card, {store: [listing]} matching offers
+    quantities = []
+    bought_card_names = []
+    for card_name in card_name_list:
+        card_data = moxfield_cards[card_name]
+        quantity = card_data.get("quantity", 1)
+        card_offers = {}
+        card_listings = {}
+        for store, cheapest_listing in card_data["listings"].items():
+            if store not in store_name_index:
+                continue
+            s = store_name_index[store]
+            covered = 0
+            for listing in card_data.get("offers", {}).get(store) or [cheapest_listing]:
+                stock = listing.get("stock")
+                capacity = quantity if stock is None else min(stock, quantity)
+                if capacity <= 0 or covered >= quantity:
+                    continue
+                card_offers.setdefault(s, []).append((round(100 * listing["price"]), capacity))
+                card_listings.setdefault(s, []).append(listing)
+                covered += capacity
+        available = sum(min(quantity, sum(capacity for _, capacity in store_offers)) for store_offers in card_offers.values())
+        if available < quantity:
+            print(f"Only {available} of {quantity} copies of {card_name} are in stock")
+            quantity = available
+        if not quantity:
+            continue
+        offers.append(card_offers)
+        offer_listings.append(card_listings)
+        quantities.append(quantity)
+        bought_card_names.append(card_name)
 
-    # Add the tiered order processing fees to the objective
-    for s in all_stores:
-        obj_expr.append(fee[s])
+    max_items = [0 for store in store_name_list]
+    for card_offers, quantity in zip(offers, quantities):
+        for s, store_offers in card_offers.items():
+            max_items[s] += min(quantity, sum(capacity for _, capacity in store_offers))
+    store_tiers = [fee_tiers(shipping_cost_map[store_name]["fees"], max(1, max_items[s])) for s, store_name in enumerate(store_name_list)]
 
-    model.Minimize(sum(obj_expr))
+    print(f"Buying {sum(quantities)} copies of {len(quantities)} cards from up to {len(store_name_list)} stores")
+    timings = {}
+    purchase = solve_quantities(offers, quantities, store_tiers, time_limit, num_workers, timings=timings)
+    if metrics is not None:
+        for phase, (phase_start, duration) in timings.items():
+            metrics.record_span(phase, phase_start, duration, cards=len(quantities))
+    if purchase is None:
+        return -1
 
-    # Creates the solver and solve.
-    solver = cp_model.CpSolver()
-    status = solver.Solve(model)
-
-    if status == cp_model.OPTIMAL:
-        for c in all_cards:
-            for s in all_stores:
-                if solver.Value(y[(c, s)]) == 1:
-                    store = store_name_list[s]
-                    card = card_name_list[c]
-                    if store in moxfield_cards[card]["listings"]:
-                        moxfield_cards[card]["optimal_listing"] = moxfield_cards[card]["listings"][store]
-                        print(f"Buy {card} from {store} for: ${moxfield_cards[card]['listings'][store]['price']}")
-                    else:
-                        moxfield_cards[card]["optimal_listing"] = None
-                        print(f"No optimal listing found for card: {card}")
-        total_shipping = 0
-        for s in all_stores:
-            store = store_name_list[s]
-            cards_bought = solver.Value(num_items_from_store[s])
-            if cards_bought:
-                print(f"Bought {cards_bought} cards from {store}: ${sum([cost_matrix[c][s] if solver.Value(y[(c, s)]) else 0 for c in all_cards])/100:.2f} + ${solver.Value(fee[s])/100:.2f} in fees")
-                total_shipping += solver.Value(fee[s])
-        print(f"Optimized Total Cost: ${(solver.ObjectiveValue()-total_shipping)/100:.2f} + ${total_shipping/100:.2f} in fees")
-
-        return solver.ObjectiveValue()/100
-    return -1
\ No newline at end of file
+    spent_at_store = [0 for store in store_name_list]
+    for card_name, card_listings, card_units in zip(bought_card_names, offer_listings, purchase):
+        purchases = [(card_listings[s][k], copies) for s, offer_units in card_units.items() for k, copies in enumerate(offer_units) if copies]
+        moxfield_cards[card_name]["purchases"] = purchases
+        moxfield_cards[card_name]["optimal_listing"] = max(purchases, key=lambda bought: bought[1])[0]
+        for listing, copies in purchases:
+            spent_at_store[store_name_index[listing["vendor"]]] += copies * round(100 * listing["price"])
+            print(f"Buy {copies}x {card_name} from {listing['vendor']} for: ${listing['price']} each")
+    total_shipping = 0
+    for s, items in enumerate(purchase_items(purchase, len(store_name_list))):
+        if items:
+            store_shipping = store_fee(store_tiers[s], items)
+            print(f"Bought {items} cards from {store_name_list[s]}: ${spent_at_store[s]/100:.2f} + ${store_shipping/100:.2f} in fees")
+            total_shipping += store_shipping
+    total_cost = sum(spent_at_store) + total_shipping
+    print(f"Optimized Total Cost: ${(total_cost-total_shipping)/100:.2f} + ${total_shipping/100:.2f} in fees")
+
+    return total_cost/100
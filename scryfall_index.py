@@ -0,0 +1,110 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCRYFALL_INDEX_PATH = "data/scryfall.sqlite"
+
+# Rows written per transaction while ingesting
+INGEST_BATCH_SIZE = 5000
+
+
+def iter_json_array(stream, chunk_size: int = 1 << 20):
+    # Yields the elements of a top level JSON array without holding the whole document in memory
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    in_array = False
+    end_of_file = False
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position < len(buffer):
+            if not in_array:
+                if buffer[position] != "[":
+                    raise ValueError("Scryfall bulk data should be a JSON array")
+                in_array = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+                yield item
+                continue
+            except json.JSONDecodeError:
+                # Most likely the element runs past the end of the buffer
+                if end_of_file:
+                    raise
+        elif end_of_file:
+            return
+        chunk = stream.read(chunk_size)
+        end_of_file = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def printing_row(card: dict):
+    art_obj = card if "image_uris" in card or "card_faces" not in card else card["card_faces"][0]
+    oracle_id = card.get("oracle_id") or card.get("card_faces", [{}])[0].get("oracle_id")
+    return (card["id"], oracle_id, card.get("name"), card.get("set"), art_obj.get("illustration_id"),
+            art_obj.get("image_uris", {}).get("small"))
+
+
+class ScryfallIndex:
+    # Printings from a Scryfall bulk data file: card id -> oracle id -> every printing's illustration and image
+    def __init__(self, path: str = SCRYFALL_INDEX_PATH):
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def available(self):
+        return os.path.exists(self.path)
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.row_factory = sqlite3.Row
+            self.connection.execute("CREATE TABLE IF NOT EXISTS printings (id TEXT PRIMARY KEY, oracle_id TEXT, name TEXT, set_code TEXT, illustration_id TEXT, image_small TEXT)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS printings_oracle ON printings (oracle_id)")
+        return self.connection
+
+    def ingest(self, cards):
+        with self.lock:
+            connection = self._connect()
+            batch = []
+            count = 0
+            for card in cards:
+                batch.append(printing_row(card))
+                if len(batch) >= INGEST_BATCH_SIZE:
+                    connection.executemany("INSERT OR REPLACE INTO printings VALUES (?, ?, ?, ?, ?, ?)", batch)
+                    connection.commit()
+                    count += len(batch)
+                    batch = []
+            connection.executemany("INSERT OR REPLACE INTO printings VALUES (?, ?, ?, ?, ?, ?)", batch)
+            connection.commit()
+            return count + len(batch)
+
+    def printing(self, card_id: str):
+        with self.lock:
+            row = self._connect().execute("SELECT * FROM printings WHERE id = ?", (card_id,)).fetchone()
+        return dict(row) if row else None
+
+    def printings_of(self, oracle_id: str):
+        with self.lock:
+            rows = self._connect().execute("SELECT * FROM printings WHERE oracle_id = ? ORDER BY id", (oracle_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index a Scryfall bulk data file (e.g. default-cards.json) for offline printing lookups")
+    parser.add_argument("bulk_file", help="Path to the downloaded bulk JSON file")
+    parser.add_argument("--index", default=SCRYFALL_INDEX_PATH, help=f"SQLite file to write (default: {SCRYFALL_INDEX_PATH})")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    with open(args.bulk_file, 'r', encoding='utf-8') as bulk_file:
+        ingested = ScryfallIndex(args.index).ingest(iter_json_array(bulk_file))
+    print(f"{time.time() - start_time:.2f}s - INFO - [Scryfall] - Indexed {ingested} printings into {args.index}")
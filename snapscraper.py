@@ -1,16 +1,19 @@
-import requests_cache
+import argparse
 import json
+import os
+import threading
 import time
 import sys
-import retailer_selection
-import re
-import imagehash
-import matplotlib.pyplot as plt
 from ListingException import ListingException
-from io import BytesIO
-from PIL import Image
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
+from rate_limiter import RateLimiter, host_from_url
+from http_cache import PolicyCachedSession
+from metrics import Metrics
+from scryfall_index import ScryfallIndex
+from listing_store import ListingStore
+from listing_pipeline import ListingFilters, MAX_LISTINGS, cheapest_per_vendor, dump_cards, listings_from_results, load_cards, reject_listings, store_url_from_listing, validate_listings, vendor_offers
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+# retailer_selection (ortools), art_index (numpy, PIL), matplotlib and selenium are imported by the stages that use them
 
 FILTERED_SITES = []
 
@@ -28,121 +31,152 @@ MIN_ACCEPTABLE_CONDITION = WEAR_LEVELS.get("HP")
 SCRIPT_START_TIME = time.time()
 
 DEFAULT_RATE_LIMIT_WAIT = 3
-API_REQUEST_HISTORY = {
+# Seconds between requests per domain, burst is how many requests may go out back to back after a quiet period
+RATE_LIMITS = {
     "catalog.snapcaster.ca": {
         "min_time_between_requests": DEFAULT_RATE_LIMIT_WAIT,
-        "number_of_requests": 0,
-        "last_request_time": SCRIPT_START_TIME
+        "burst": 1
     },
     "api2.moxfield.com": {
         "min_time_between_requests": DEFAULT_RATE_LIMIT_WAIT,
-        "number_of_requests": 0,
-        "last_request_time": SCRIPT_START_TIME
+        "burst": 1
     },
     "api.scryfall.com": {
         "min_time_between_requests": 0.1,
-        "number_of_requests": 0,
-        "last_request_time": SCRIPT_START_TIME
+        "burst": 1
     },
     "cards.scryfall.io": {
         "min_time_between_requests": 0.1,
-        "number_of_requests": 0,
-        "last_request_time": SCRIPT_START_TIME
+        "burst": 10
     },
     "cdn.shopify.com": {
         "min_time_between_requests": 0.1,
-        "number_of_requests": 0,
-        "last_request_time": SCRIPT_START_TIME
+        "burst": 10
     },
     "cc-client-assets.nyc3.cdn.digitaloceanspaces.com": {
         "min_time_between_requests": 0.1,
-        "number_of_requests": 0,
-        "last_request_time": SCRIPT_START_TIME
+        "burst": 10
     },
     "conduct-catalog-images.s3-us-west-2.amazonaws.com": {
         "min_time_between_requests": 0.1,
-        "number_of_requests": 0,
-        "last_request_time": SCRIPT_START_TIME
+        "burst": 10
     },
     "crystalcommerce-assets.nyc3.cdn.digitaloceanspaces.com": {
         "min_time_between_requests": 0.1,
-        "number_of_requests": 0,
-        "last_request_time": SCRIPT_START_TIME
+        "burst": 10
     }
 }
-
-ART_SIZE = (146, 204)
+STORE_RATE_LIMIT_WAIT = 1
+MAX_THROTTLE_RETRIES = 3
+
+# Pipeline stages in the order they run, the CLI can select any subset
+STAGES = ("scrape", "optimize", "cart", "browser")
+
+# Every run appends its phase timings and per-domain request histograms here as one JSON line
+METRICS_REPORT_PATH = "data/metrics.jsonl"
+
+# Stores whose carts are filled at once
+CART_CONCURRENCY = 8
+
+# Cart URLs and their cookies, written instead of opening a browser for workers that check out on their own
+CART_HANDOFF_PATH = "data/carts.json"
+# How often an idle run checks whether the browser is still open
+BROWSER_POLL_INTERVAL = 2
+
+# Printing images of one card downloaded and hashed at once
+IMAGE_FETCH_CONCURRENCY = 8
+
+# Number of cards scraped at once, 1 reproduces the old sequential behaviour
+SCRAPE_CONCURRENCY = 4
+
+# "sequential" fetches result pages one after another, "parallel" fetches every page after the first at once,
+# "lazy" stops as soon as LAZY_MIN_VENDORS distinct vendors have a valid listing
+PAGINATION_MODE = "parallel"
+SNAPCASTER_MAX_PAGES = 5
+LAZY_MIN_VENDORS = 10
+
+# Seconds the optimizer may search before settling for the best assignment so far, None waits for the optimum.
+# 0 workers uses every core.
+OPTIMIZE_TIME_LIMIT = 60
+OPTIMIZE_WORKERS = 0
+
+# Reuse the assignment stored by the deck's previous run, skipping the solve if no listing changed
+INCREMENTAL_OPTIMIZE = True
+
+# Seconds a cached response stays fresh, by URL pattern. Prices change often, printing images never do.
+CACHE_NAME = "mtg_cache"
+DEFAULT_CACHE_EXPIRY = 24 * 60 * 60
+CACHE_EXPIRY = {
+    "catalog.snapcaster.ca": 60 * 60,
+    "api2.moxfield.com": 10 * 60,
+    "api.scryfall.com": 7 * 24 * 60 * 60,
+    "cards.scryfall.io": -1,
+    "cdn.shopify.com": 30 * 24 * 60 * 60,
+}
+# Seconds past expiry a response is still answered from the cache while a fresh copy is fetched in the background
+CACHE_STALE_WHILE_REVALIDATE = 12 * 60 * 60
+# Least recently used responses are evicted at the end of the scrape once the cache is larger than this
+MAX_CACHE_BYTES = 512 * 1024 * 1024
 
 
 full_deck_id = "abcdefghijklmnopqrstuvwxyz"
 FULL_DECK_URL = f"https://www.moxfield.com/decks/{full_deck_id}"
 
-def get_override(request_url: str, headers=None):
-    rate_limit_config = check_rate_limit(request_url)
-
+def get_override(request_url: str, headers=None, force_refresh: bool = False):
+    # Cached answers don't need to wait on the rate limiter, force_refresh always fetches and re-caches the response
+    if not force_refresh:
+        lookup_start = time.time()
+        cached_response = request_session.cached(request_url, headers=headers)
+        if cached_response is not None:
+            metrics.record_request(host_from_url(request_url), time.time() - lookup_start, 0, "stale" if cached_response.is_expired else "hit")
+            return cached_response
     if headers:
-        response = request_session.get(request_url, headers=headers)
-    else:
-        response = request_session.get(request_url)
-    if rate_limit_config:
-        rate_limit_config["number_of_requests"] += 1
-        rate_limit_config["last_request_time"] = time.time()
-
-    return response
-
-def post_override(request_url: str, session):
-    rate_limit_config = check_rate_limit(request_url)
-    response = session.post(request_url)
-
-    if rate_limit_config:
-        rate_limit_config["number_of_requests"] += 1
-        rate_limit_config["last_request_time"] = time.time()
-
-    return response
-
-def check_rate_limit(full_url):
-    match = re.search('https?://([A-Za-z_0-9.-]+).*', full_url)
-    if match:
-        base_url = match.group(1)
-    else:
-        print(f"{time.time() - SCRIPT_START_TIME:.2f}s - ERROR - [REQUESTS] - Could not identify domain from url: {full_url}")
+        return rate_limited_request(request_url, lambda: request_session.get(request_url, headers=headers, force_refresh=force_refresh))
+    return rate_limited_request(request_url, lambda: request_session.get(request_url, force_refresh=force_refresh))
+
+def post_override(request_url: str, session, json_body=None):
+    if json_body is not None:
+        return rate_limited_request(request_url, lambda: session.post(request_url, json=json_body))
+    return rate_limited_request(request_url, lambda: session.post(request_url))
+
+def rate_limited_request(request_url: str, send_request):
+    host = host_from_url(request_url)
+    if host is None:
+        print(f"{time.time() - SCRIPT_START_TIME:.2f}s - ERROR - [REQUESTS] - Could not identify domain from url: {request_url}")
         time.sleep(DEFAULT_RATE_LIMIT_WAIT)
-        return None
-            
-    if base_url not in API_REQUEST_HISTORY:
-        print(f"{time.time() - SCRIPT_START_TIME:.2f}s - DEBUG - [REQUESTS] - Rate limit not configured for domain: {base_url}")
-        API_REQUEST_HISTORY[base_url] = {
-            "min_time_between_requests": DEFAULT_RATE_LIMIT_WAIT,
-            "number_of_requests": 0,
-            "last_request_time": SCRIPT_START_TIME
-        }
-
-    url_config = API_REQUEST_HISTORY[base_url]
-    min_time_between_requests = url_config["min_time_between_requests"]
-    last_request_time = url_config["last_request_time"]
-
-    wait_increment = min_time_between_requests / 10
-    while time.time() - last_request_time < min_time_between_requests:
-        time.sleep(wait_increment)
-    return url_config
+        return send_request()
+
+    if not rate_limiter.is_configured(host):
+        print(f"{time.time() - SCRIPT_START_TIME:.2f}s - DEBUG - [REQUESTS] - Rate limit not configured for domain: {host}")
+
+    for _ in range(MAX_THROTTLE_RETRIES + 1):
+        wait_time = rate_limiter.acquire(host)
+        request_start = time.time()
+        response = send_request()
+        throttled = rate_limiter.report_response(host, response)
+        metrics.record_request(host, time.time() - request_start, wait_time, "throttled" if throttled else "network")
+        if not throttled:
+            break
+        print(f"{time.time() - SCRIPT_START_TIME:.2f}s - WARNING - [REQUESTS] - Throttled by {host} (HTTP {response.status_code}), backing off")
+    return response
 
 def same_set(set1: str, set2: str):
     loweredSet1 = str.lower(set1)
     loweredSet2 = str.lower(set2)
     return [c for c in loweredSet1 if c.isalpha()] == [c for c in loweredSet2 if c.isalpha()]
 
-def listing_to_cart(store_base_url: str, sku_variant_id):
+def configure_store_rate_limit(store_base_url: str):
+    store_host = host_from_url(store_base_url)
+    if store_host and not rate_limiter.is_configured(store_host):
+        rate_limiter.configure(store_host, STORE_RATE_LIMIT_WAIT)
+
+def listing_to_cart(store_base_url: str, sku_variant_id, quantity: int = 1):
     # Going to assume that snapcaster will only link to in-stock products
     # Shopfiy allows you to add an out-of-stock card to cart as longs as the 
     # variant id is associated with a product.
 
-    API_REQUEST_HISTORY[store_base_url] = {
-        "min_time_between_requests": 1,
-        "number_of_requests": 0,
-        "last_request_time": SCRIPT_START_TIME
-    }
-
-    response = post_override(f'{store_base_url}/cart/add.js?quantity=1&id={sku_variant_id}', request_session)
+    configure_store_rate_limit(store_base_url)
+    response = post_override(f'{store_base_url}/cart/add.js?quantity={quantity}&id={sku_variant_id}', request_session)
 
     if response.status_code != 200:
         return False
@@ -150,8 +184,51 @@ def listing_to_cart(store_base_url: str, sku_variant_id):
     active_carts.add(f"{store_base_url}/cart")
     return True
 
-def store_url_from_listing(listing: dict[str, str]):
-    return listing['link'].split('/products/')[0]
+def store_listings_to_cart(store_base_url: str, card_purchases: dict):
+    with metrics.span("store_cart_add", store=store_base_url, cards=len(card_purchases)):
+        return listings_to_cart(store_base_url, card_purchases)
+
+def listings_to_cart(store_base_url: str, card_purchases: dict):
+    # Adds every card bought from one store in a single request, card_purchases maps card names to [(listing, copies)].
+    # Returns {card_name: reason} for the ones that failed.
+    configure_store_rate_limit(store_base_url)
+    failures = {}
+    purchased_items = []
+    cart_items = []
+    for card_name, purchases in card_purchases.items():
+        for listing, copies in purchases:
+            # Shopify only takes numeric variant ids, a listing without one fails on its own instead of sinking the batch
+            variant_id = str(listing.get("variant_id") or "")
+            if not variant_id.isdigit():
+                failures[card_name] = f"no usable variant id ({listing.get('variant_id')!r})"
+                continue
+            purchased_items.append((card_name, listing, copies))
+            cart_items.append({"id": int(variant_id), "quantity": copies})
+    if not cart_items:
+        return failures
+    response = post_override(f'{store_base_url}/cart/add.js', request_session, json_body={"items": cart_items})
+
+    if response.status_code == 200:
+        active_carts.add(f"{store_base_url}/cart")
+        try:
+            added_variants = {str(item["variant_id"]) for item in response.json().get("items", [])}
+        except (ValueError, AttributeError):
+            return failures
+        failures.update({card_name: "missing from the cart response" for card_name, listing, _ in purchased_items
+                         if str(listing["variant_id"]) not in added_variants})
+        return failures
+
+    # Shopify rejects the whole batch when one item can't be added, so find out which one it was item by item
+    if len(purchased_items) == 1:
+        try:
+            reason = response.json().get("description") or f"HTTP {response.status_code}"
+        except ValueError:
+            reason = f"HTTP {response.status_code}"
+        failures[purchased_items[0][0]] = reason
+        return failures
+    failures.update({card_name: f"HTTP {response.status_code}" for card_name, listing, copies in purchased_items
+                     if not listing_to_cart(store_base_url, listing["variant_id"], copies)})
+    return failures
 
 def get_cards_from_moxfield_deck(deck_id: str):
     headers = {
@@ -190,6 +267,7 @@ def get_cards_from_moxfield_deck(deck_id: str):
 
         moxfield_card = {}
         moxfield_card["isFoil"] = card["isFoil"]
+        moxfield_card["quantity"] = card.get("quantity", 1)
         moxfield_card["cardSet"] = data["set_name"]
         moxfield_card["cardName"] = cardname
         moxfield_card["scryfall_id"] = data["scryfall_id"]
@@ -198,31 +276,92 @@ def get_cards_from_moxfield_deck(deck_id: str):
     print(f"{time.time() - SCRIPT_START_TIME:.2f}s - INFO - [Moxfield] - Response parsed: {len(cards)} Cards To Find")
     return cards
 
-def get_listings_from_snapcaster(card_name: str):
+def snapcaster_search_page(card_name: str, page_num: int, force_refresh: bool = False):
+    response = get_override(f'https://catalog.snapcaster.ca/api/v1/search?index=ca_singles_mtg_prod*&keyword={card_name}&sortBy=price-asc&maxResultsPerPage=100&pageNumber={page_num}', force_refresh=force_refresh)
+    return json.loads(response.text)
+
+def get_listings_from_snapcaster(card_name: str, card_num: int, pagination_mode: str = PAGINATION_MODE, force_refresh: bool = False):
     print(f"{time.time() - SCRIPT_START_TIME:.2f}s - INFO - [Snapcaster] - ({card_num}/{number_of_cards}) - Scraping Listings for '{card_name}'")
-    listings = []
-    x = get_override(f'https://catalog.snapcaster.ca/api/v1/search?index=ca_singles_mtg_prod*&keyword={card_name}&sortBy=price-asc&maxResultsPerPage=100&pageNumber=1')
-    response_json = json.loads(x.text)
-    num_pages = response_json["pagination"]["numPages"]
-    listings.extend(response_json['results'])
-    for pageNum in range(2, min(6, num_pages+1)):
-        x = get_override(f'https://catalog.snapcaster.ca/api/v1/search?index=ca_singles_mtg_prod*&keyword={card_name}&sortBy=price-asc&maxResultsPerPage=100&pageNumber={pageNum}')
-        response_json = json.loads(x.text)
-        listings.extend(response_json['results'])
+    response_json = snapcaster_search_page(card_name, 1, force_refresh)
+    listings = listings_from_results(response_json['results'])
+    num_pages = min(SNAPCASTER_MAX_PAGES, response_json["pagination"]["numPages"])
+    remaining_pages = range(2, num_pages + 1)
+
+    if pagination_mode == "parallel" and remaining_pages:
+        # Pages still queue on the snapcaster rate limit, but their round trips overlap
+        with ThreadPoolExecutor(max_workers=len(remaining_pages)) as executor:
+            for page_json in executor.map(lambda page_num: snapcaster_search_page(card_name, page_num, force_refresh), remaining_pages):
+                listings.extend(listings_from_results(page_json['results']))
+        return listings
+
+    # Results are sorted by price, so once enough vendors have a valid listing the later pages only hold pricier copies
+    valid_vendors = set()
+    page_results = listings
+    for page_num in remaining_pages:
+        if pagination_mode == "lazy":
+            valid_vendors.update(listing["vendor"] for listing in page_results if not listing_filters.rejection(card_name, listing))
+            if len(valid_vendors) >= LAZY_MIN_VENDORS:
+                print(f"{time.time() - SCRIPT_START_TIME:.2f}s - DEBUG - [Snapcaster] - ({card_num}/{number_of_cards}) - '{card_name}' - Stopping after {page_num - 1}/{num_pages} pages, {len(valid_vendors)} vendors found")
+                break
+        page_results = listings_from_results(snapcaster_search_page(card_name, page_num, force_refresh)['results'])
+        listings.extend(page_results)
     return listings
 
-def rmsdiff(im1, im2):
-    # "Calculate the root-mean-square difference between two images"
-    # diff = ImageChops.difference(im1, im2)
-    # h = diff.histogram()
-    # sq = (value*((idx%256)**2) for idx, value in enumerate(h))
-    # sum_of_squares = sum(sq)
-    # rms = math.sqrt(sum_of_squares/float(im1.size[0] * im1.size[1]))
-    hash1 = imagehash.average_hash(im1)
-    hash2 = imagehash.average_hash(im2)
-    return hash1 - hash2
+def get_scryfall_printings(scryfall_id: str):
+    # Returns the card's illustration id and every printing as {"id", "illustration_id", "image_small"},
+    # from the offline bulk data index when it has the card and from the Scryfall API otherwise
+    if scryfall_index.available():
+        card_printing = scryfall_index.printing(scryfall_id)
+        if card_printing:
+            return card_printing["illustration_id"], scryfall_index.printings_of(card_printing["oracle_id"])
+
+    scryfall_card = json.loads(get_override(f"https://api.scryfall.com/cards/{scryfall_id}").text)
+    scryfall_art_obj = scryfall_card if "image_uris" in scryfall_card else scryfall_card["card_faces"][0]
+    scryfall_printings = []
+    next_page = scryfall_card['prints_search_uri']
+    while next_page:
+        scryfall_printings_response = json.loads(get_override(next_page).text)
+        for printing in scryfall_printings_response["data"]:
+            printing_art_obj = printing if "image_uris" in printing else printing["card_faces"][0]
+            scryfall_printings.append({"id": printing["id"], "illustration_id": printing_art_obj["illustration_id"], "image_small": printing_art_obj["image_uris"]["small"]})
+        next_page = scryfall_printings_response.get("next_page") if scryfall_printings_response.get("has_more") else None
+    return scryfall_art_obj["illustration_id"], scryfall_printings
+
+def fetch_art_hash(image_url: str):
+    from art_index import image_hash_from_bytes
+    return image_hash_from_bytes(get_override(image_url).content)
+
+def get_art_index():
+    # The hash index pulls in numpy and PIL, so it is only opened once an image check needs it
+    global art_index
+    with art_index_lock:
+        if art_index is None:
+            from art_index import ArtHashIndex
+            art_index = ArtHashIndex()
+        return art_index
+
+def hash_printings(card_map, stat_map):
+    # Every printing is hashed once and remembered on disk. Missing ones are downloaded and hashed together,
+    # the rate limiter still spaces out the requests to each image host.
+    from art_index import printing_hash_arrays
+    art_index = get_art_index()
+    scryfall_printings = card_map["scryfall_printings"]
+    known_hashes = art_index.get([printing["id"] for printing in scryfall_printings])
+    missing_printings = [printing for printing in scryfall_printings if printing["id"] not in known_hashes]
+    if missing_printings:
+        with ThreadPoolExecutor(max_workers=min(IMAGE_FETCH_CONCURRENCY, len(missing_printings))) as executor:
+            fetched_hashes = executor.map(lambda printing: fetch_art_hash(printing["image_small"]), missing_printings)
+            for printing, art_hash in zip(missing_printings, fetched_hashes):
+                known_hashes[printing["id"]] = art_hash
+                art_index.put(printing["id"], printing["illustration_id"], art_hash)
+                stat_map["image_requests"] += 1
+
+    printing_hashes = [known_hashes[printing["id"]] for printing in scryfall_printings]
+    is_good_art = [printing["illustration_id"] == card_map["good_art_id"] for printing in scryfall_printings]
+    card_map["printing_hashes"], card_map["is_good_art"] = printing_hash_arrays(printing_hashes, is_good_art)
 
 def display_images(images, titles=None):
+    # images can be decoded images or image urls, urls are downloaded (through the cache) and decoded here
     # Calculate the number of rows and columns based on the number of images
     num_images = len(images)
     if not num_images:
@@ -230,10 +369,15 @@ def display_images(images, titles=None):
     rows = max(1, (num_images + 3) // 4)  # Display 4 images per row
     cols = max(1, min(4, num_images))
     
+    import matplotlib.pyplot as plt
     fig, axes = plt.subplots(rows, cols, figsize=(4 * cols, 4 * rows))
     axes = axes.flatten() if num_images > 1 else [axes]  # Flatten in case there's more than 1 image
 
     for i, img in enumerate(images):
+        if isinstance(img, str):
+            from io import BytesIO
+            from PIL import Image
+            img = Image.open(BytesIO(get_override(img).content))
         axes[i].imshow(img)
         if titles:
             axes[i].set_title(titles[i])
@@ -247,58 +391,38 @@ def display_images(images, titles=None):
     plt.show()
     pass
 
-def check_valid_image(card_name, card_data, card_image_map, listing, stat_map, scan_all=False):
+def check_valid_image(card_name, card_data, card_image_map, listing, stat_map, card_num, scan_all=False):
     if card_name not in card_image_map:
         card_image_map[card_name] = {}
         card_map = card_image_map[card_name]
         set_showcase_map = {}
         card_map["set_showcase_map"] = set_showcase_map
-        printing_images = {}
-        card_map["printing_images"] = printing_images
         bad_listings = []
         card_map["bad_listings"] = bad_listings
         good_listings = []
         card_map["good_listings"] = good_listings
 
-        scryfall_card = json.loads(get_override(f"https://api.scryfall.com/cards/{card_data['scryfall_id']}").text)
-        scryfall_printings_response = json.loads(get_override(f"{scryfall_card['prints_search_uri']}").text)
-        scryfall_art_obj = scryfall_card if "image_uris" in scryfall_card else scryfall_card["card_faces"][0]
-        good_art_id = scryfall_art_obj["illustration_id"]
+        with metrics.span("image_check", card=card_name):
+            good_art_id, scryfall_printings = get_scryfall_printings(card_data['scryfall_id'])
         card_map["good_art_id"] = good_art_id
 
-        num_printings = scryfall_printings_response["total_cards"]
+        num_printings = len(scryfall_printings)
         num_illustrations = -1
         card_map["num_printings"] = num_printings
-        
-
-
-        good_art = Image.open(BytesIO(get_override(f"{scryfall_art_obj['image_uris']['small']}").content)).convert("RGB").resize(ART_SIZE, Image.Resampling.LANCZOS)
-        card_map["good_art"] = good_art
-
-        bad_arts = {}
-        card_map["bad_arts"] = bad_arts
-
-        scryfall_printings = scryfall_printings_response["data"]
         card_map["scryfall_printings"] = scryfall_printings
-    
+
         unique_art_ids = {good_art_id}
         for printing in scryfall_printings:
-            printing_art_obj = printing if "image_uris" in printing else printing["card_faces"][0]
-            unique_art_ids.add(printing_art_obj["illustration_id"])
+            unique_art_ids.add(printing["illustration_id"])
 
         num_illustrations = len(unique_art_ids)
         card_map["num_illustrations"] = num_illustrations
     else:
         card_map = card_image_map[card_name]
-        good_art_id = card_map["good_art_id"]
         num_printings = card_map["num_printings"]
         set_showcase_map = card_map["set_showcase_map"]
-        printing_images = card_map["printing_images"]
         good_listings = card_map["good_listings"]
         bad_listings = card_map["bad_listings"]
-        good_art = card_map.get("good_art", None)
-        bad_arts = card_map.get("bad_arts", None)
-        scryfall_printings = card_map.get("scryfall_printings", None)
         num_illustrations = card_map.get("num_illustrations", None)
         
     if num_illustrations > 1:
@@ -309,29 +433,20 @@ def check_valid_image(card_name, card_data, card_image_map, listing, stat_map, s
                 return False
         else:
             set_showcase_map[map_key] = False
-            listing_img = Image.open(BytesIO(get_override(listing["image"]).content)).convert("RGB").resize(ART_SIZE, Image.Resampling.LANCZOS)
+            with metrics.span("image_check", card=card_name):
+                if "printing_hashes" not in card_map:
+                    hash_printings(card_map, stat_map)
+                listing_hash = fetch_art_hash(listing["image"])
             stat_map["image_requests"] += 1
-            good_art_best_comparison = 1000
-            bad_art_best_comparison = 1000
-            for printing in scryfall_printings:
-                printing_art_obj = printing if "image_uris" in printing else printing["card_faces"][0]
-                art_id = printing_art_obj["illustration_id"] 
-                card_id = printing["id"]
-                if card_id not in printing_images:
-                    printing_images[card_id] = Image.open(BytesIO(get_override(f"{printing_art_obj['image_uris']['small']}").content)).convert("RGB").resize(ART_SIZE, Image.Resampling.LANCZOS)
-                    stat_map["image_requests"] += 1
-                art = printing_images[card_id]
-                art_comparison = rmsdiff(art, listing_img)
-                if art_id == good_art_id:
-                    good_art_best_comparison = min(good_art_best_comparison, art_comparison)
-                else:
-                    bad_art_best_comparison = min(bad_art_best_comparison, art_comparison)
+            from art_index import best_art_distances
+            good_art_best_comparison, bad_art_best_comparison = best_art_distances(card_map["printing_hashes"], card_map["is_good_art"], listing_hash)
+            # Only the image urls are kept, display_images downloads and decodes them when it is asked to show them
             if bad_art_best_comparison < good_art_best_comparison:
                 stat_map["image"] += 1
-                bad_listings.append(listing_img)
+                bad_listings.append(listing["image"])
                 return False
             else:
-                good_listings.append(listing_img)
+                good_listings.append(listing["image"])
             set_showcase_map[map_key] = True
     else:
         if num_illustrations == 1 and "one_art" not in card_map:
@@ -343,79 +458,30 @@ def check_valid_image(card_name, card_data, card_image_map, listing, stat_map, s
     
     return True
 
-request_session = requests_cache.CachedSession('mtg_cache')
-active_carts = set()
-
-if "decks/" in FULL_DECK_URL:
-    moxfield_id = FULL_DECK_URL.split("decks/")[1]
-else:
-    moxfield_id = FULL_DECK_URL
-
-moxfield_cards = get_cards_from_moxfield_deck(moxfield_id)
-number_of_cards = len(moxfield_cards)
-
-retailer_names = set()
-cards_to_drop = set()
-
-card_image_set_map = dict()
-card_miss_stats = {card_name:{"nerdz": 0, "name": 0, "foil": 0, "art_series": 0, "shopify": 0, "condition": 0, "image": 0, "image_requests": 0, "valid_listings": 0} for card_name in moxfield_cards.keys()}
-
-card_num = 0
-for card_name, card_data in moxfield_cards.items():
+def scrape_card(card_num: int, card_name: str, card_data: dict, stat_map: dict, force_refresh: bool = False):
+    # Runs on a worker thread, so results are returned rather than written to the shared sets
     try:
-        card_num += 1
-        stat_map = card_miss_stats[card_name]
-
-        listings = get_listings_from_snapcaster(card_name)
-        number_of_listings = min(len(listings), 500)
-        card_data["all_listings"] = listings[:number_of_listings]
-        
-        listing_num = 0
-        for listing in listings[:number_of_listings]:
-            print(f"{time.time() - SCRIPT_START_TIME:.2f}s - DEBUG - [Snapcaster] - ({listing_num}/{number_of_listings}) - '{card_name}' - Validating Listings...", end='\r', flush=True)
-            listing_num += 1
-            store_base_url = store_url_from_listing(listing)
-
-            bad_site = False
-            for site in FILTERED_SITES:
-                if site in store_base_url:
-                    bad_site = True
-            if bad_site:
-                continue
-
-            if listing["name"] != card_name:
-                stat_map["name"] += 1
-                continue
-
-            # if (listing["foil"] != '') != (card_data["isFoil"] == True):
-            #     stat_map["foil"] += 1
-            #     continue
-
-            if listing["art_series"]:
-                stat_map["art_series"] += 1
-                continue
-
-            # if "shopify" not in listing["image"]:
-            #     stat_map["shopify"] += 1
-            #     continue
+        with metrics.span("snapcaster_scrape", card=card_name):
+            listings = get_listings_from_snapcaster(card_name, card_num, force_refresh=force_refresh)
+    except Exception as e:
+        print(f"{time.time() - SCRIPT_START_TIME:.2f}s - ERROR - [Snapcaster] - ({card_num}/{number_of_cards}) - '{card_name}' - Dropping card due to unexpected error: {e}")
+        return set(), True
+    with metrics.span("validation", card=card_name):
+        return select_card_listings(card_num, card_name, card_data, listings, stat_map)
 
-            if WEAR_LEVELS[listing["condition"]] > MIN_ACCEPTABLE_CONDITION:
-                stat_map["condition"] += 1
-                continue
-            
-            # if not check_valid_image(card_name, card_data, card_image_set_map, listing, stat_map):
-            #     stat_map["image"] += 1
-            #     continue
-
-            retailer = listing["vendor"]
-            stat_map["valid_listings"] += 1
-            if retailer in card_data["listings"]:
-                stored_price = card_data["listings"][retailer]["price"]
-                if listing["price"] >= stored_price:
-                    continue
-            
-            retailer_names.add(retailer)
-            card_data["listings"][retailer] = listing
+def select_card_listings(card_num: int, card_name: str, card_data: dict, listings, stat_map: dict):
+    # listings can be any iterable of snapcaster results, e.g. read_listings() over a saved response
+    dropped = False
+    try:
+        listings = list(islice(listings, MAX_LISTINGS))
+        card_data["all_listings"] = listings
+
+        card_data["listings"] = validate_listings(card_name, listings, listing_filters, stat_map)
+        # card_data["listings"] = validate_listings(card_name, listings, listing_filters, stat_map,
+        #     extra_stages=[("image", lambda listing: not check_valid_image(card_name, card_data, card_image_set_map, listing, stat_map, card_num))])
+        if card_data.get("quantity", 1) > 1:
+            # A vendor's cheapest copy might not be enough on its own, so keep the listings needed to cover every copy
+            card_data["offers"] = vendor_offers(listing_filters.apply(card_name, listings), card_data["quantity"])
         if not len(card_data['listings'].keys()):
             raise ListingException("Failed to find a valid listing in snapcaster response", listings)
         elif len(card_data['listings'].keys()) >= 5:
@@ -427,22 +493,9 @@ for card_name, card_data in moxfield_cards.items():
 
     except ListingException as le:
         print(f"{time.time() - SCRIPT_START_TIME:.2f}s - ERROR - [Snapcaster] - ({card_num}/{number_of_cards}) - '{card_name}' - No valid listings, defaulting to first 30")
-        found_backup = False
-        for listing in le.listings:
-            if listing["name"] != card_name:
-                continue
-            retailer = listing["vendor"]
-            if retailer in card_data["listings"]:
-                stored_price = card_data["listings"][retailer]["price"]
-                if listing["price"] >= stored_price:
-                    continue
-
-            # if not check_valid_image(card_name, card_data, card_image_set_map, listing, stat_map, scan_all=True):
-            #     continue
-
-            retailer_names.add(retailer)
-            card_data["listings"][retailer] = listing
-            found_backup = True
+        backup_listings = reject_listings(le.listings, "name", lambda listing: listing["name"] != card_name)
+        # backup_listings = (listing for listing in backup_listings if check_valid_image(card_name, card_data, card_image_set_map, listing, stat_map, card_num, scan_all=True))
+        found_backup = bool(cheapest_per_vendor(backup_listings, card_data["listings"]))
         if not found_backup:
             for listing in le.listings[:min(len(le.listings), 30)]:
                 # store_base_url = store_url_from_listing(listing)
@@ -459,84 +512,383 @@ for card_name, card_data in moxfield_cards.items():
                     stored_price = card_data["listings"][retailer]["price"]
                     if listing["price"] >= stored_price:
                         continue
-                retailer_names.add(retailer)
                 card_data["listings"][retailer] = listing
                 found_backup = True
         if not found_backup:
-            cards_to_drop.add(card_name)
+            dropped = True
             print(f"{time.time() - SCRIPT_START_TIME:.2f}s - ERROR - [Snapcaster] - ({card_num}/{number_of_cards}) - '{card_name}' - Default listings are all invalid")    
-        continue
     except Exception as e:
-        cards_to_drop.add(card_name)
+        dropped = True
         print(f"{time.time() - SCRIPT_START_TIME:.2f}s - ERROR - [Snapcaster] - ({card_num}/{number_of_cards}) - '{card_name}' - Dropping card due to unexpected error: {e}")
     
     # display_images(card_image_set_map[card_name]["good_listings"])
     # display_images(card_image_set_map[card_name]["bad_listings"])
 
-with open(f"data/{moxfield_id}", 'w') as card_data_file:
-    json.dump(moxfield_cards, card_data_file, indent=4)
-
-for drop in cards_to_drop:
-    del moxfield_cards[drop]
+    return set(card_data["listings"]), dropped
+
+def scrape_and_checkpoint(card_num: int, card_name: str, card_data: dict, stat_map: dict, run_id: int | None):
+    # Saves the card to the listing store the moment it finishes, so a crash later in the deck doesn't lose it
+    card_retailers, dropped = scrape_card(card_num, card_name, card_data, stat_map)
+    if run_id is not None:
+        listing_store.add_card(run_id, card_name, card_data, dropped, stat_map)
+    return card_retailers, dropped
+
+def scrape_cards(moxfield_cards: dict, card_miss_stats: dict, run_id: int | None = None):
+    # Cards are scraped concurrently but merged back in deck order so the output matches a sequential run.
+    # With a run_id each card is checkpointed to the listing store as soon as it is scraped.
+    retailer_names = set()
+    cards_to_drop = set()
+    with metrics.span("scrape", cards=len(moxfield_cards)), ThreadPoolExecutor(max_workers=SCRAPE_CONCURRENCY) as executor:
+        card_futures = [executor.submit(scrape_and_checkpoint, card_num, card_name, card_data, card_miss_stats[card_name], run_id)
+                        for card_num, (card_name, card_data) in enumerate(moxfield_cards.items(), start=1)]
+        for card_name, card_future in zip(moxfield_cards.keys(), card_futures):
+            card_retailers, dropped = card_future.result()
+            retailer_names.update(card_retailers)
+            if dropped:
+                cards_to_drop.add(card_name)
+    return retailer_names, cards_to_drop
+
+metrics = Metrics(SCRIPT_START_TIME)
+rate_limiter = RateLimiter(RATE_LIMITS, DEFAULT_RATE_LIMIT_WAIT)
+request_session = PolicyCachedSession(CACHE_NAME, max_cache_bytes=MAX_CACHE_BYTES,
+                                      before_refresh=lambda url: rate_limiter.acquire(host_from_url(url) or ""),
+                                      expire_after=DEFAULT_CACHE_EXPIRY, urls_expire_after=CACHE_EXPIRY,
+                                      stale_while_revalidate=CACHE_STALE_WHILE_REVALIDATE)
+listing_filters = ListingFilters(FILTERED_SITES, WEAR_LEVELS, MIN_ACCEPTABLE_CONDITION)
+art_index = None
+art_index_lock = threading.Lock()
+scryfall_index = ScryfallIndex()
+listing_store = ListingStore()
+active_carts = set()
+card_image_set_map = dict()
+# Set once the deck is fetched, only used in log lines
+number_of_cards = 0
+
+def deck_id_from_url(deck_url: str):
+    if "decks/" in deck_url:
+        return deck_url.split("decks/")[1]
+    return deck_url
+
+def scrape_deck(moxfield_id: str, run_id: int, resume: bool = False):
+    # With resume, cards the run already checkpointed are taken from the listing store and only the rest are scraped
+    global number_of_cards
+    with metrics.span("moxfield_fetch", deck=moxfield_id):
+        moxfield_cards = get_cards_from_moxfield_deck(moxfield_id)
+    number_of_cards = len(moxfield_cards)
+
+    completed_cards = listing_store.load_run(run_id) if resume else {}
+    card_miss_stats = new_card_miss_stats(moxfield_cards)
+    card_miss_stats.update(listing_store.card_stats(run_id) if resume else {})
+    retailer_names = set()
+    cards_to_drop = set()
+    for card_name, card_data in completed_cards.items():
+        if card_name not in moxfield_cards:
+            continue
+        moxfield_cards[card_name].update(card_data)
+        retailer_names.update(card_data["listings"])
+        if card_data["dropped"]:
+            cards_to_drop.add(card_name)
+    if completed_cards:
+        print(f"{time.time() - SCRIPT_START_TIME:.2f}s - INFO - [Resume] - {len(completed_cards)}/{number_of_cards} cards already scraped in run {run_id}")
+
+    remaining_cards = {card_name: card_data for card_name, card_data in moxfield_cards.items() if card_name not in completed_cards}
+    remaining_retailers, remaining_drops = scrape_cards(remaining_cards, card_miss_stats, run_id)
+    retailer_names.update(remaining_retailers)
+    cards_to_drop.update(remaining_drops)
+    report_cache()
+    return moxfield_cards, retailer_names, cards_to_drop
+
+def new_card_miss_stats(card_names):
+    return {card_name:{"nerdz": 0, "site": 0, "name": 0, "foil": 0, "art_series": 0, "shopify": 0, "condition": 0, "image": 0, "image_requests": 0, "valid_listings": 0} for card_name in card_names}
+
+def report_cache():
+    for domain, domain_stats in request_session.stats().items():
+        print(f"{time.time() - SCRIPT_START_TIME:.2f}s - DEBUG - [Cache] - {domain}: {domain_stats['hits']} hits, {domain_stats['stale']} stale, {domain_stats['misses']} misses")
+    evicted_responses = request_session.trim()
+    if evicted_responses:
+        print(f"{time.time() - SCRIPT_START_TIME:.2f}s - INFO - [Cache] - Evicted {evicted_responses} least recently used responses")
+
+def stored_cards(deck: str):
+    run_id = listing_store.latest_run(deck)
+    return listing_store.load_run(run_id) if run_id is not None else None
+
+def optimize_deck(moxfield_cards: dict, retailer_names: set, previous_cards: dict | None = None):
+    import retailer_selection
+    optimize_start_time = time.time()
+    print(f"{optimize_start_time - SCRIPT_START_TIME:.2f}s - INFO - [Optimization] - Optimizing retailers by cost and shipping fees")
+    with metrics.span("optimize", cards=len(moxfield_cards), stores=len(retailer_names)):
+        optimal_cost = retailer_selection.process(moxfield_cards, retailer_names, OPTIMIZE_TIME_LIMIT, OPTIMIZE_WORKERS, previous_cards, metrics)
+    optimize_end_time = time.time()
+    print(f"{optimize_end_time - SCRIPT_START_TIME:.2f}s - INFO - [Optimization] - Optimization complete in {optimize_end_time - optimize_start_time:.2f}s. Total cost: ${optimal_cost:.2f}")
+    return optimal_cost
+
+def add_deck_to_carts(moxfield_cards: dict):
+    # One request per store, with the stores running at once
+    store_card_listings = {}
+    for card_name, card_data in moxfield_cards.items():
+        listing = card_data.get("optimal_listing")
+        if not listing:
+            print(f"{time.time() - SCRIPT_START_TIME:.2f}s - ERROR - [Adding to Cart] - '{card_name}' Had no optimal listing")
+            continue
+        for purchased_listing, copies in card_data.get("purchases") or [(listing, 1)]:
+            store_card_listings.setdefault(store_url_from_listing(purchased_listing), {}).setdefault(card_name, []).append((purchased_listing, copies))
 
-optimize_start_time = time.time()
-print(f"{optimize_start_time - SCRIPT_START_TIME:.2f}s - INFO - [Optimization] - Optimizing retailers by cost and shipping fees")
-optimal_cost = retailer_selection.process(moxfield_cards, retailer_names)
-optimize_end_time = time.time()
-print(f"{optimize_end_time - SCRIPT_START_TIME:.2f}s - INFO - [Optimization] - Optimization complete in {optimize_end_time - optimize_start_time:.2f}s. Total cost: ${optimal_cost:.2f}")
-pass
+    print(f"{time.time() - SCRIPT_START_TIME:.2f}s - INFO - [Adding to Cart] - Adding {sum(len(card_listings) for card_listings in store_card_listings.values())} cards to {len(store_card_listings)} carts")
+    if not store_card_listings:
+        return
+    with metrics.span("cart_add", stores=len(store_card_listings)), ThreadPoolExecutor(max_workers=min(CART_CONCURRENCY, len(store_card_listings))) as executor:
+        store_failures = executor.map(lambda store: store_listings_to_cart(store, store_card_listings[store]), store_card_listings)
+        for store_base_url, failed_cards in zip(store_card_listings, store_failures):
+            card_listings = store_card_listings[store_base_url]
+            print(f"{time.time() - SCRIPT_START_TIME:.2f}s - INFO - [Adding to Cart] - {store_base_url} - Added {len(card_listings) - len(failed_cards)}/{len(card_listings)} cards")
+            for card_name, reason in failed_cards.items():
+                print(f"{time.time() - SCRIPT_START_TIME:.2f}s - ERROR - [Adding to Cart] - Failed to add '{card_name}' to {card_listings[card_name][0][0]['website']} cart: {reason}")
+
+def cart_cookies(domain: str | None = None):
+    # The session's cookies as Network.setCookies parameters, optionally only those sent to domain
+    cookies = []
+    for cookie in request_session.cookies:
+        cookie_domain = cookie.domain.lstrip('.')
+        if domain is not None and domain != cookie_domain and not domain.endswith('.' + cookie_domain):
+            continue
+        cookie_param = {'domain': cookie.domain, 'name': cookie.name, 'value': cookie.value, 'secure': cookie.secure}
+        if cookie.expires:
+            cookie_param['expires'] = cookie.expires
+        if cookie.path_specified:
+            cookie_param['path'] = cookie.path
+        cookies.append(cookie_param)
+    return cookies
+
+def export_carts(path: str = CART_HANDOFF_PATH):
+    # Writes every filled cart with the cookies that hold it, so another worker can pick the carts up without Selenium
+    carts = [{"url": store_url, "cookies": cart_cookies(host_from_url(store_url))} for store_url in sorted(active_carts)]
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as carts_file:
+        json.dump({"carts": carts}, carts_file, indent=2)
+    for cart in carts:
+        print(f"{time.time() - SCRIPT_START_TIME:.2f}s - INFO - [Carts] - {cart['url']}")
+    print(f"{time.time() - SCRIPT_START_TIME:.2f}s - INFO - [Carts] - Wrote {len(carts)} carts to {path}")
+    return carts
+
+def open_carts_in_browser():
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+
+    with metrics.span("browser_handoff", carts=len(active_carts)):
+        browser_options = Options()
+        # Tabs are opened without waiting for each cart page to finish loading
+        browser_options.page_load_strategy = "none"
+        driver = webdriver.Chrome(options=browser_options)
+
+        cookies = cart_cookies()
+        print(f"{time.time() - SCRIPT_START_TIME:.2f}s - INFO - [Cookies] - Importing {len(cookies)} cart cookies into Selenium")
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setCookies', {'cookies': cookies})
+        driver.execute_cdp_cmd('Network.disable', {})
+
+        print(f"{time.time() - SCRIPT_START_TIME:.2f}s - INFO - [Chrome Carts] - {len(active_carts)} Active Carts")
+        for cart_num, store_url in enumerate(active_carts):
+            if cart_num == 0:
+                driver.get(store_url)
+            else:
+                driver.execute_cdp_cmd('Target.createTarget', {'url': store_url, 'background': True})
+    return driver
 
-with open(f"data/{moxfield_id}", 'r') as card_data_file:
-    file_dict = json.load(card_data_file)
+def wait_for_browser(driver, stop_event: threading.Event | None = None):
+    # Keeps the carts open until every browser window is closed, stop_event is set or the run is interrupted
+    from selenium.common.exceptions import WebDriverException
 
-for name, data in moxfield_cards.items():
-    if name in file_dict:
-        if "optimal_listing" in data:
-            file_dict[name]["optimal_listing"] = data["optimal_listing"]
-        else:
-            file_dict[name]["optimal_listing"] = {}
-
-with open(f"data/{moxfield_id}", 'w') as card_data_file:
-    json.dump(file_dict, card_data_file, indent=4)
-    
-num_added_to_cart = 0
-for card_name, card_data in moxfield_cards.items():
-    num_added_to_cart += 1
-    print(f"{time.time() - SCRIPT_START_TIME:.2f}s - INFO - [Adding to Cart] - ({num_added_to_cart}/{number_of_cards}) - '{card_name}'")
-    listing = card_data["optimal_listing"]
-    if not listing:
-        print(f"{time.time() - SCRIPT_START_TIME:.2f}s - ERROR - [Adding to Cart] - ({num_added_to_cart}/{number_of_cards}) - '{card_name}' Had no optimal listing")
-        continue
-    addedToCart = listing_to_cart(store_url_from_listing(listing), listing["variant_id"])
-    if not addedToCart:
-        print(f"{time.time() - SCRIPT_START_TIME:.2f}s - ERROR - [Adding to Cart] - ({num_added_to_cart}/{number_of_cards}) - Failed to add '{card_name}' to {listing['website']} cart")
-
-
-browser_options = Options()
-driver = webdriver.Chrome(chrome_options=browser_options)
-
-print(f"{time.time() - SCRIPT_START_TIME:.2f}s - INFO - [Cookies] - Importing cart cookies into Selenium")
-driver.execute_cdp_cmd('Network.enable', {})
-for cookie in request_session.cookies:
-    cookie_dict = {'domain': cookie.domain, 'name': cookie.name, 'value': cookie.value, 'secure': cookie.secure}
-    if cookie.expires:
-        cookie_dict['expiry'] = cookie.expires
-    if cookie.path_specified:
-        cookie_dict['path'] = cookie.path
-    set_cookie = driver.execute_cdp_cmd('Network.setCookie', cookie_dict)
-driver.execute_cdp_cmd('Network.disable', {})
-
-
-print(f"{time.time() - SCRIPT_START_TIME:.2f}s - INFO - [Chrome Carts] - {len(active_carts)} Active Carts")
-chrome_opened = False
-for store_url in active_carts:
-    if chrome_opened:
-        driver.switch_to.new_window('tab')
+    stop_event = threading.Event() if stop_event is None else stop_event
+    try:
+        while not stop_event.wait(BROWSER_POLL_INTERVAL):
+            try:
+                if not driver.window_handles:
+                    break
+            except WebDriverException:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
+
+def run(deck_url: str = FULL_DECK_URL, stages=STAGES, output_path: str | None = None, resume: bool = False):
+    # Runs the selected stages in order and returns (total cost or None, cards, browser driver or None).
+    # Scraped listings and the chosen assignment are kept in the listing store, without the scrape stage the cards
+    # come from the deck's latest stored run. resume continues the deck's last run from the cards it already scraped.
+    # output_path also exports the final card data as a dump_cards file.
+    global number_of_cards
+    moxfield_id = deck_id_from_url(deck_url)
+    unknown_stages = set(stages) - set(STAGES)
+    if unknown_stages:
+        raise ValueError(f"Unknown stages: {', '.join(sorted(unknown_stages))}")
+
+    resume_run = listing_store.latest_run(moxfield_id, scraped_only=False) if resume and "scrape" in stages else None
+    if resume_run is not None and listing_store.run_finished(resume_run):
+        resume_run = None
+    # The run being resumed is not its own previous run
+    previous_run = listing_store.latest_run(moxfield_id, before=resume_run)
+    previous_cards = None
+    if previous_run is not None:
+        previous_cards = listing_store.load_run(previous_run)
+    elif os.path.exists(f"data/{moxfield_id}"):
+        # Card data file from before the listing store
+        with open(f"data/{moxfield_id}", 'r') as card_data_file:
+            previous_cards = load_cards(card_data_file)
+
+    if "scrape" in stages:
+        run_id = resume_run if resume_run is not None else listing_store.start_run(moxfield_id)
+        moxfield_cards, retailer_names, cards_to_drop = scrape_deck(moxfield_id, run_id, resume_run is not None)
+        for drop in cards_to_drop:
+            del moxfield_cards[drop]
+    elif previous_run is not None:
+        run_id = previous_run
+        moxfield_cards = {card_name: card_data for card_name, card_data in previous_cards.items() if card_data["listings"] and not card_data["dropped"]}
+        retailer_names = {retailer for card_data in moxfield_cards.values() for retailer in card_data["listings"]}
+        number_of_cards = len(moxfield_cards)
+        # The stored run is the one being optimized, reusing its own assignment would never re-solve it
+        previous_cards = None
     else:
-        chrome_opened = True
-    driver.get(store_url)
-
-done_time = time.time()
-print(f"{done_time - SCRIPT_START_TIME:.2f}s - INFO - [Done] - Total Cost ${optimal_cost:.2f}")
-while(True):
-    pass
\ No newline at end of file
+        raise LookupError(f"No stored scrape of deck '{moxfield_id}', run the scrape stage first")
+    if not INCREMENTAL_OPTIMIZE:
+        previous_cards = None
+
+    optimal_cost = None
+    if "optimize" in stages:
+        optimal_cost = optimize_deck(moxfield_cards, retailer_names, previous_cards)
+        listing_store.finish_run(run_id, optimal_cost, moxfield_cards)
+    elif "scrape" in stages:
+        # Every card was scraped, so there's nothing left for --resume to continue
+        listing_store.mark_finished(run_id)
+
+    if output_path:
+        with open(output_path, 'w') as card_data_file:
+            dump_cards(moxfield_cards, card_data_file)
+
+    if "cart" in stages:
+        add_deck_to_carts(moxfield_cards)
+
+    driver = None
+    if "browser" in stages:
+        driver = open_carts_in_browser()
+
+    metrics.write_report(METRICS_REPORT_PATH, deck=moxfield_id, cards=number_of_cards, stages=list(stages), total_cost=optimal_cost,
+                         rate_limits=rate_limiter.stats(), cache=request_session.stats())
+    for phase, phase_totals in metrics.phase_totals().items():
+        print(f"{time.time() - SCRIPT_START_TIME:.2f}s - DEBUG - [Metrics] - {phase}: {phase_totals['count']}x, {phase_totals['total']:.2f}s total, {phase_totals['max']:.2f}s max")
+
+    if optimal_cost is not None:
+        print(f"{time.time() - SCRIPT_START_TIME:.2f}s - INFO - [Done] - Total Cost ${optimal_cost:.2f}")
+    return optimal_cost, moxfield_cards, driver
+
+def run_batch(deck_urls: list[str], stages=STAGES, joint: bool = False):
+    # Scrapes every card that appears in any of the decks once, then optimizes each deck on its own from the shared
+    # listings or, with joint, every deck as one order so each store's shipping is paid once. Cards wanted by several
+    # decks are bought once per deck, in joint mode as one entry for every deck's copies so a listing's stock is only
+    # spent once. Returns ({deck or batch key: total cost}, {deck: cards}, browser driver or None).
+    global number_of_cards
+    unknown_stages = set(stages) - set(STAGES)
+    if unknown_stages:
+        raise ValueError(f"Unknown stages: {', '.join(sorted(unknown_stages))}")
+    if "scrape" not in stages:
+        raise ValueError("Batch runs always scrape, use run() to re-optimize a single stored deck")
+
+    deck_cards = {}
+    unique_cards = {}
+    for moxfield_id in dict.fromkeys(deck_id_from_url(deck_url) for deck_url in deck_urls):
+        with metrics.span("moxfield_fetch", deck=moxfield_id):
+            deck_cards[moxfield_id] = get_cards_from_moxfield_deck(moxfield_id)
+        for card_name, card_data in deck_cards[moxfield_id].items():
+            if card_name not in unique_cards:
+                unique_cards[card_name] = dict(card_data)
+            elif joint:
+                unique_cards[card_name]["quantity"] = unique_cards[card_name].get("quantity", 1) + card_data.get("quantity", 1)
+            else:
+                unique_cards[card_name]["quantity"] = max(unique_cards[card_name].get("quantity", 1), card_data.get("quantity", 1))
+    number_of_cards = len(unique_cards)
+    print(f"{time.time() - SCRIPT_START_TIME:.2f}s - INFO - [Batch] - {len(deck_cards)} decks hold {sum(len(cards) for cards in deck_cards.values())} cards, {len(unique_cards)} unique")
+
+    _, cards_to_drop = scrape_cards(unique_cards, new_card_miss_stats(unique_cards))
+    report_cache()
+
+    # Each deck gets its own card dicts over the shared listings, so optimal listings don't leak between decks.
+    # Offers were gathered for the most copies any deck (or in joint mode, all of them) asks for, which covers each deck's own quantity.
+    deck_runs = {}
+    for moxfield_id, cards in deck_cards.items():
+        previous_cards = stored_cards(moxfield_id) if INCREMENTAL_OPTIMIZE and not joint else None
+        deck_runs[moxfield_id] = (listing_store.start_run(moxfield_id), previous_cards)
+        for card_name, card_data in cards.items():
+            cards[card_name] = {**unique_cards[card_name], "quantity": card_data.get("quantity", 1)}
+            listing_store.add_card(deck_runs[moxfield_id][0], card_name, cards[card_name], card_name in cards_to_drop)
+
+    if joint:
+        # One entry per card holding every deck's copies, which is also how the carts are filled
+        combined_cards = {card_name: card_data for card_name, card_data in unique_cards.items() if card_name not in cards_to_drop}
+    else:
+        # Every deck's cards under "<deck id>/<card name>", which is also how the carts are filled
+        combined_cards = {f"{moxfield_id}/{card_name}": card_data for moxfield_id, cards in deck_cards.items()
+                          for card_name, card_data in cards.items() if card_name not in cards_to_drop}
+
+    costs = {}
+    if "optimize" in stages and joint:
+        batch_key = "batch:" + "+".join(sorted(deck_cards))
+        previous_cards = stored_cards(batch_key) if INCREMENTAL_OPTIMIZE else None
+        batch_run = listing_store.start_run(batch_key)
+        for card_key, card_data in combined_cards.items():
+            listing_store.add_card(batch_run, card_key, card_data)
+        retailer_names = {retailer for card_data in combined_cards.values() for retailer in card_data["listings"]}
+        costs[batch_key] = optimize_deck(combined_cards, retailer_names, previous_cards)
+        listing_store.finish_run(batch_run, costs[batch_key], combined_cards)
+        # The joint assignment is only kept in the batch run, a deck's own run has no purchases of its own
+        for moxfield_id, cards in deck_cards.items():
+            listing_store.finish_run(deck_runs[moxfield_id][0], None, cards)
+    elif "optimize" in stages:
+        for moxfield_id, cards in deck_cards.items():
+            run_id, previous_cards = deck_runs[moxfield_id]
+            deck_cards_to_buy = {card_name: card_data for card_name, card_data in cards.items() if card_name not in cards_to_drop}
+            retailer_names = {retailer for card_data in deck_cards_to_buy.values() for retailer in card_data["listings"]}
+            print(f"{time.time() - SCRIPT_START_TIME:.2f}s - INFO - [Batch] - Optimizing deck '{moxfield_id}'")
+            costs[moxfield_id] = optimize_deck(deck_cards_to_buy, retailer_names, previous_cards)
+            listing_store.finish_run(run_id, costs[moxfield_id], cards)
+    else:
+        for run_id, _ in deck_runs.values():
+            listing_store.mark_finished(run_id)
+
+    if "cart" in stages:
+        add_deck_to_carts(combined_cards)
+
+    driver = None
+    if "browser" in stages:
+        driver = open_carts_in_browser()
+
+    metrics.write_report(METRICS_REPORT_PATH, decks=list(deck_cards), cards=number_of_cards, stages=list(stages), joint=joint, total_cost=costs,
+                         rate_limits=rate_limiter.stats(), cache=request_session.stats())
+    for deck, cost in costs.items():
+        print(f"{time.time() - SCRIPT_START_TIME:.2f}s - INFO - [Done] - {deck} - Total Cost ${cost:.2f}")
+    return costs, deck_cards, driver
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find the cheapest way to buy a Moxfield deck from Snapcaster listings")
+    parser.add_argument("decks", nargs="*", default=[FULL_DECK_URL], help="Moxfield deck ids or URLs, several run as a batch")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"Comma separated stages to run, from {', '.join(STAGES)}")
+    parser.add_argument("--output", default=None, help="Also export the final card data to this file")
+    parser.add_argument("--joint", action="store_true", help="Optimize a batch of decks as one order")
+    parser.add_argument("--resume", action="store_true", help="Continue the deck's last unfinished run, skipping the cards it already scraped")
+    parser.add_argument("--no-browser", action="store_true", help="Skip Selenium and write the cart URLs and cookies to --carts-output instead")
+    parser.add_argument("--carts-output", default=CART_HANDOFF_PATH, help=f"Where --no-browser writes the carts (default: {CART_HANDOFF_PATH})")
+    args = parser.parse_args()
+
+    stages = [stage for stage in args.stages.split(",") if stage and not (args.no_browser and stage == "browser")]
+    if len(args.decks) > 1:
+        _, _, driver = run_batch(args.decks, stages, args.joint)
+    else:
+        _, _, driver = run(args.decks[0], stages, args.output, args.resume)
+    if args.no_browser and "cart" in stages:
+        export_carts(args.carts_output)
+    if driver is not None:
+        wait_for_browser(driver)